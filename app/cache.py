@@ -0,0 +1,223 @@
+# app/cache.py
+# Cache di processo per dati "quasi statici" (postazioni): le pagine e gli
+# endpoint che leggono solo id/nome/prefisso non rifanno la SELECT ogni volta.
+# Le view admin che modificano le Kitchen chiamano invalidate_kitchens(),
+# quelle che modificano prodotti/categorie invalidate_catalog().
+from __future__ import annotations
+
+from contextvars import ContextVar
+from typing import NamedTuple, Optional
+
+from sqlmodel import select, Session
+
+from .models import Category, Kitchen, Product
+from .models_customizations import ProductPrompt
+
+
+# Generazione delle cache: ogni invalidate_* la incrementa. I loader la leggono
+# PRIMA della SELECT e salvano il risultato solo se nel frattempo non è cambiata:
+# una SELECT partita prima di un commit admin (i loader girano anche nel
+# threadpool) non può rimettere in cache uno snapshot vecchio dopo l'invalidazione.
+_CACHE_GEN = 0
+
+
+def _bump_cache_gen() -> None:
+    global _CACHE_GEN
+    _CACHE_GEN += 1
+
+
+class KitchenRow(NamedTuple):
+    """Snapshot immutabile di una Kitchen (indipendente dalla sessione)."""
+    id: int
+    name: str
+    prefix: str
+
+
+_KITCHENS: Optional[dict[int, KitchenRow]] = None
+_KITCHENS_SORTED: dict[str, tuple[KitchenRow, ...]] = {}
+
+
+def kitchens_map(session: Session) -> dict[int, KitchenRow]:
+    """{kitchen_id: KitchenRow}; carica dal DB solo al primo uso o dopo un'invalidazione."""
+    global _KITCHENS
+    hit = _KITCHENS
+    if hit is None:
+        gen = _CACHE_GEN
+        hit = {
+            k.id: KitchenRow(k.id, k.name, k.prefix)
+            for k in session.exec(select(Kitchen)).all()
+        }
+        if gen == _CACHE_GEN:
+            _KITCHENS = hit
+    return hit
+
+
+def kitchens_list(session: Session, order_by: str = "name") -> tuple[KitchenRow, ...]:
+    """Postazioni ordinate per `name` o `prefix` (menu, index, display)."""
+    hit = _KITCHENS_SORTED.get(order_by)
+    if hit is None:
+        gen = _CACHE_GEN
+        hit = tuple(sorted(
+            kitchens_map(session).values(), key=lambda k: (getattr(k, order_by), k.id)
+        ))
+        if gen == _CACHE_GEN:
+            _KITCHENS_SORTED[order_by] = hit
+    return hit
+
+
+def invalidate_kitchens() -> None:
+    global _KITCHENS
+    _bump_cache_gen()
+    _KITCHENS = None
+    _KITCHENS_SORTED.clear()
+    invalidate_catalog()  # eliminare una postazione scollega prodotti/categorie
+    bump_tickets_version()  # le postazioni compaiono anche nei fragment
+
+
+# Catalogo del POS (prodotti + categorie): cambia solo dall'admin, ma /pos
+# lo renderizza a ogni apertura.
+class ProductRow(NamedTuple):
+    id: int
+    name: str
+    price_cents: int
+    kitchen_id: Optional[int]
+    category_id: Optional[int]
+    image_url: Optional[str]
+
+
+class CategoryRow(NamedTuple):
+    id: int
+    name: str
+    kitchen_id: Optional[int]
+    color_hex: Optional[str]
+
+
+_CATALOG: Optional[tuple[tuple[ProductRow, ...], dict[int, CategoryRow]]] = None
+
+
+def pos_catalog(session: Session) -> tuple[tuple[ProductRow, ...], dict[int, CategoryRow]]:
+    """(prodotti ordinati per nome, {category_id: CategoryRow})."""
+    global _CATALOG
+    hit = _CATALOG
+    if hit is None:
+        gen = _CACHE_GEN
+        # Solo le colonne degli snapshot, nell'ordine dei NamedTuple: niente entità ORM
+        products = tuple(
+            ProductRow(*r)
+            for r in session.exec(
+                select(Product.id, Product.name, Product.price_cents,
+                       Product.kitchen_id, Product.category_id, Product.image_url)
+                .order_by(Product.name_lower)
+            ).all()
+        )
+        categories = {
+            r[0]: CategoryRow(*r)
+            for r in session.exec(
+                select(Category.id, Category.name, Category.kitchen_id, Category.color_hex)
+            ).all()
+        }
+        hit = (products, categories)
+        if gen == _CACHE_GEN:
+            _CATALOG = hit
+    return hit
+
+
+_PRODUCTS_BY_ID: Optional[dict[int, ProductRow]] = None
+
+
+def products_map(session: Session) -> dict[int, ProductRow]:
+    """{product_id: ProductRow}, derivato dal catalogo (checkout: zero SELECT a regime)."""
+    global _PRODUCTS_BY_ID
+    hit = _PRODUCTS_BY_ID
+    if hit is None:
+        gen = _CACHE_GEN
+        hit = {p.id: p for p in pos_catalog(session)[0]}
+        if gen == _CACHE_GEN:
+            _PRODUCTS_BY_ID = hit
+    return hit
+
+
+def invalidate_catalog() -> None:
+    global _CATALOG, _PRODUCTS_BY_ID
+    _bump_cache_gen()
+    _CATALOG = None
+    _PRODUCTS_BY_ID = None
+    bump_tickets_version()  # i nomi prodotto compaiono nei fragment KDS (e nei loro ETag)
+
+
+# Personalizzazioni per prodotto: il POS le chiede a ogni click su un prodotto.
+# Le scrive solo l'admin (salvataggio prompt, eliminazione prodotto).
+_PROMPTS: dict[int, list[dict]] = {}
+
+
+def product_prompts(session: Session, product_id: int) -> list[dict]:
+    """Prompt del prodotto già nel formato JSON del POS."""
+    hit = _PROMPTS.get(product_id)
+    if hit is None:
+        # l'id arriva dal client: si mettono in cache solo prodotti esistenti,
+        # altrimenti id arbitrari farebbero crescere _PROMPTS senza limite
+        if product_id not in products_map(session):
+            return []
+        gen = _CACHE_GEN
+        hit = [
+            {
+                "name": r.name,
+                "kind": r.kind,
+                "required": bool(r.required),
+                "choices": r.choices or [],
+                "delta": int(r.delta_cents or 0),
+            }
+            for r in session.exec(
+                select(ProductPrompt).where(ProductPrompt.product_id == product_id)
+            ).all()
+        ]
+        if gen == _CACHE_GEN:
+            _PROMPTS[product_id] = hit
+    return hit
+
+
+def invalidate_prompts(product_id: int) -> None:
+    _bump_cache_gen()
+    _PROMPTS.pop(product_id, None)
+
+
+# Versione dei ticket: incrementata a ogni scrittura (checkout, azioni KDS,
+# operazioni admin). Le cache dei fragment la usano come chiave, così si
+# invalidano all'evento e non solo allo scadere del TTL.
+_TICKETS_VERSION = 0
+
+
+def tickets_version() -> int:
+    return _TICKETS_VERSION
+
+
+def bump_tickets_version() -> None:
+    global _TICKETS_VERSION
+    _TICKETS_VERSION += 1
+
+
+# Memo per-richiesta: lookup ripetuti nella stessa richiesta (azione KDS +
+# render del fragment, pagina + sottomenu) non toccano nemmeno la cache di processo.
+# Il dict lo crea RequestMemoMiddleware; fuori da una richiesta vale None.
+_REQUEST_MEMO: ContextVar[Optional[dict]] = ContextVar("_REQUEST_MEMO", default=None)
+
+
+def request_memo() -> Optional[dict]:
+    return _REQUEST_MEMO.get()
+
+
+class RequestMemoMiddleware:
+    """Middleware ASGI puro: un dict nuovo per ogni richiesta HTTP/WS."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = _REQUEST_MEMO.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _REQUEST_MEMO.reset(token)
@@ -1,5 +1,6 @@
 from sqlmodel import SQLModel, create_engine, Session, select
-from sqlalchemy import event
+from sqlalchemy import bindparam, event, func, inspect, literal, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 import os
 
 # Modelli (solo import: nessuna logica qui)
@@ -34,12 +35,92 @@ if IS_SQLITE:
         cur.execute("PRAGMA journal_mode=WAL;")
         # Timeout quando il DB è lockato da un writer
         cur.execute("PRAGMA busy_timeout=30000;")
-        # Facoltativo: cur.execute("PRAGMA synchronous=NORMAL;")
+        # Con WAL, NORMAL è sicuro (niente corruzione) e risparmia un fsync per commit
+        cur.execute("PRAGMA synchronous=NORMAL;")
         cur.close()
 
+def group_concat(expr, sep: str, *order_by):
+    """Concatenazione aggregata ordinata per `order_by`.
+
+    SQLite: group_concat segue l'ordine della subquery ordinata da cui legge
+    (il chiamante deve ordinarla allo stesso modo). PostgreSQL non garantisce
+    quell'ordine dopo l'aggregazione: lì l'ORDER BY va dentro string_agg.
+    """
+    if IS_SQLITE:
+        return func.group_concat(expr, sep)
+    if order_by:
+        return func.string_agg(expr, aggregate_order_by(literal(sep), *order_by))
+    return func.string_agg(expr, sep)
+
+def format_dt(expr):
+    """Data/ora come testo 'gg/mm/aaaa hh:mm:ss' calcolata dal DB (niente strftime per riga)."""
+    if IS_SQLITE:
+        return func.strftime("%d/%m/%Y %H:%M:%S", expr)
+    return func.to_char(expr, "DD/MM/YYYY HH24:MI:SS")
+
 # ---- Schema ----
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    ensure_columns()
+    ensure_indexes()
+
+def _add_column(conn, table: str, column: str, extra: str = "") -> None:
+    """ALTER TABLE ADD COLUMN col tipo dal modello, compilato per il dialetto in uso
+    (DATETIME su SQLite, TIMESTAMP su PostgreSQL, ...)."""
+    col_type = SQLModel.metadata.tables[table].c[column].type.compile(dialect=engine.dialect)
+    quote = engine.dialect.identifier_preparer.quote
+    conn.exec_driver_sql(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {col_type}{extra}")
+
+def ensure_columns():
+    """Colonne aggiunte dopo la prima versione: ALTER TABLE + backfill sui DB esistenti.
+    DDL e backfill sono portabili (SQLite e PostgreSQL); i tipi vengono dai modelli."""
+    cols = {c["name"] for c in inspect(engine).get_columns("ticket")}
+    if "order_created_at" not in cols:
+        with engine.begin() as conn:
+            _add_column(conn, "ticket", "order_created_at")
+            conn.exec_driver_sql(
+                'UPDATE ticket SET order_created_at = '
+                '(SELECT created_at FROM "order" WHERE "order".id = ticket.order_id)'
+            )
+
+    cols = {c["name"] for c in inspect(engine).get_columns("printedreceipt")}
+    if "printer_host" not in cols:
+        with engine.begin() as conn:
+            _add_column(conn, "printedreceipt", "printer_host")
+            _add_column(conn, "printedreceipt", "printer_port")
+            _add_column(conn, "printedreceipt", "printer_enabled", " NOT NULL DEFAULT false")
+            conn.exec_driver_sql(
+                "UPDATE printedreceipt SET "
+                "printer_host = (SELECT host FROM printer WHERE printer.id = printedreceipt.printer_id), "
+                "printer_port = (SELECT port FROM printer WHERE printer.id = printedreceipt.printer_id), "
+                "printer_enabled = COALESCE("
+                "(SELECT enabled FROM printer WHERE printer.id = printedreceipt.printer_id), false)"
+            )
+
+    cols = {c["name"] for c in inspect(engine).get_columns("product")}
+    if "name_lower" not in cols:
+        with engine.begin() as conn:
+            _add_column(conn, "product", "name_lower", " NOT NULL DEFAULT ''")
+            # backfill con str.lower() come i listener (LOWER() di SQLite è solo ASCII)
+            rows = conn.execute(select(Product.id, Product.name)).all()
+            if rows:
+                conn.execute(
+                    update(Product).where(Product.id == bindparam("pid"))
+                    .values(name_lower=bindparam("nl")),
+                    [{"pid": pid, "nl": (name or "").lower()} for pid, name in rows],
+                )
+
+# Indici sostituiti da versioni più complete: sui DB esistenti vanno rimossi
+_OBSOLETE_INDEXES = ("ix_ticket_kitchen_status",)
+
+def ensure_indexes():
+    """create_all non tocca le tabelle già esistenti: crea qui gli indici mancanti."""
+    for table in SQLModel.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for name in _OBSOLETE_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
 
 # ---- Sessioni: dipendenza FastAPI corretta ----
 def get_session_dep():
@@ -1,8 +1,8 @@
 from pathlib import Path
 from fastapi import FastAPI, Request, WebSocket
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, PlainTextResponse, FileResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, FileResponse
 from fastapi.websockets import WebSocketDisconnect
 from starlette.responses import RedirectResponse
 from starlette.staticfiles import StaticFiles
@@ -14,6 +14,8 @@ import os
 
 from .db import create_db_and_tables, seed_if_empty
 from . import views_pos, views_kds, views_display, views_admin
+from .cache import RequestMemoMiddleware
+from .templating import make_templates
 from .ws import manager
 from .paths import STATIC_DIR, TEMPLATES_DIR, UPLOADS_DIR
 
@@ -21,7 +23,11 @@ from .paths import STATIC_DIR, TEMPLATES_DIR, UPLOADS_DIR
 from .routers import views_receipts
 
 # ✅ crea l'app PRIMA di includere i router
-app = FastAPI(title="Calcione POS — Responsive")
+# Le route che ritornano dict/list serializzano con orjson
+app = FastAPI(title="Calcione POS — Responsive", default_response_class=ORJSONResponse)
+# Fragment e pagine in polling: compressi sopra i 512 byte (le 304 restano vuote)
+app.add_middleware(GZipMiddleware, minimum_size=512)
+app.add_middleware(RequestMemoMiddleware)
 class CachingStaticFiles(StaticFiles):
     async def get_response(self, path, scope):
         resp = await super().get_response(path, scope)
@@ -33,7 +39,7 @@ class CachingStaticFiles(StaticFiles):
 # Static e templates
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 app.mount("/uploads", CachingStaticFiles(directory=str(UPLOADS_DIR)), name="uploads")  # <-- NEW
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+templates = make_templates()
 
 
         
@@ -55,7 +61,8 @@ def index(request: Request):
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    # ?prefix=C: il client riceve solo gli eventi della sua postazione
+    await manager.connect(websocket, websocket.query_params.get("prefix"))
     try:
         while True:
             await websocket.receive_text()
@@ -3,7 +3,8 @@ from __future__ import annotations
 
 from typing import Optional
 from sqlmodel import SQLModel, Field
-from datetime import datetime
+from sqlalchemy import Index, event, func
+from datetime import datetime, timezone
 
 class Kitchen(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -26,27 +27,61 @@ class Product(SQLModel, table=True):
     kitchen_id: Optional[int] = Field(default=None, foreign_key="kitchen.id")
     category_id: Optional[int] = Field(default=None, foreign_key="category.id")
     image_url: Optional[str] = None
+    # Chiave di ordinamento del catalogo (nome minuscolo, indicizzata): la
+    # scrivono i listener qui sotto, non va impostata a mano
+    name_lower: str = Field(default="", index=True)
     # ⚠️ NESSUNA relationship qui: usiamo solo FK e query per product_id
 
 
+@event.listens_for(Product, "before_insert")
+@event.listens_for(Product, "before_update")
+def _product_name_lower(mapper, connection, target: Product) -> None:
+    target.name_lower = (target.name or "").lower()
+
+
 class Order(SQLModel, table=True):
+    # range su created_at (storico/vendite/export) + ORDER BY created_at DESC
+    __table_args__ = (Index("ix_order_created_at_id", "created_at", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     paid_method: str = "cash"
     total_cents: int = Field(default=0, nullable=False)
-    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    # UTC naive (come il resto dello schema). Il valore lo mette Python: il checkout
+    # lo riusa subito (ticket, KDS) senza rileggere la riga. Il default lato DB
+    # copre gli INSERT fatti a mano/da script, ma solo sui DB creati da create_all
+    # (ensure_columns non altera il default delle tabelle esistenti).
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        sa_column_kwargs={"server_default": func.current_timestamp()},
+    )
 
 
 class Ticket(SQLModel, table=True):
+    # (kitchen_id, pickup_seq): MAX(pickup_seq) per cucina = lettura in coda all'indice
+    # (kitchen_id, status, pickup_seq): KDS/display per postazione, già ordinati per seq
+    # (status, pickup_seq): display "tutti" (solo status = 'ready')
+    __table_args__ = (
+        Index("ix_ticket_kitchen_seq", "kitchen_id", "pickup_seq"),
+        Index("ix_ticket_kitchen_status_seq", "kitchen_id", "status", "pickup_seq"),
+        Index("ix_ticket_status_seq", "status", "pickup_seq"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     kitchen_id: int = Field(foreign_key="kitchen.id")
-    order_id: int = Field(foreign_key="order.id")
+    order_id: int = Field(foreign_key="order.id", index=True)
     pickup_seq: int
     status: str = "queued"
+    # copia di Order.created_at: il KDS calcola l'età senza JOIN sugli ordini
+    order_created_at: Optional[datetime] = None
 
 
 class OrderLine(SQLModel, table=True):
+    # righe di un ticket KDS: (kitchen_id, pickup_seq, order_id)
+    __table_args__ = (Index("ix_orderline_kps", "kitchen_id", "pickup_seq", "order_id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    order_id: int = Field(foreign_key="order.id")
+    order_id: int = Field(foreign_key="order.id", index=True)
     product_id: int = Field(foreign_key="product.id")
     qty: int = 1
     kitchen_id: Optional[int] = Field(default=None, foreign_key="kitchen.id")
@@ -49,6 +49,11 @@ class PrintedReceipt(SQLModel, table=True):
     template_id: Optional[int] = Field(default=None, index=True)
     printer_id: int = Field(index=True)
     kitchen_id: Optional[int] = Field(default=None, index=True)
+    # copia della stampante (allineata da update/delete printer): la ristampa
+    # legge solo questa tabella, senza JOIN né get() su Printer
+    printer_host: Optional[str] = None
+    printer_port: Optional[int] = None
+    printer_enabled: bool = False
 
     body: str
     cut: bool = True
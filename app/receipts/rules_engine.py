@@ -191,6 +191,9 @@ def apply_receipt_rules(session, order_id: int):
                 template_id=tpl.id,
                 printer_id=prn.id,
                 kitchen_id=(kit.id if kit else None),
+                printer_host=prn.host,
+                printer_port=prn.port,
+                printer_enabled=bool(prn.enabled),
                 body=text,
                 cut=bool(tpl.cut),
                 status=status,
@@ -8,8 +8,7 @@ from typing import Optional, List, Annotated
 
 from fastapi import APIRouter, Depends, Form, Request, Query, UploadFile, File, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy import func
+from sqlalchemy import func, update
 from sqlmodel import select, delete, desc, Session
 
 from ..paths import UPLOADS_DIR
@@ -20,10 +19,11 @@ from ..receipts.models_receipts import (
 )
 from ..receipts.rules_engine import apply_receipt_rules
 from ..receipts.printing_service import print_text
+from ..templating import make_templates
 
 SAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+templates = make_templates()
 
 # ---- Dipendenza tipizzata per la sessione ----
 SessionDep = Annotated[Session, Depends(get_session_dep)]
@@ -316,6 +316,14 @@ def delete_template(session: SessionDep, tpl_id: int = Form(...)):
     return RedirectResponse(url="/admin/receipts", status_code=303)
 
 # ---------- PRINTERS ----------
+def _sync_receipt_printer(session: Session, printer_id: int, host: str, port: int, enabled: bool) -> None:
+    """Allinea la copia della stampante sugli scontrini già stampati (usata dalla ristampa)."""
+    session.exec(
+        update(PrintedReceipt)
+        .where(PrintedReceipt.printer_id == printer_id)
+        .values(printer_host=host, printer_port=port, printer_enabled=bool(enabled))
+    )
+
 @router.post("/admin/receipts/printer/create")
 def create_printer(
     session: SessionDep,
@@ -352,14 +360,18 @@ def update_printer(
         elif selected_logo:
             p.logo_path = str((logos_dir / safe_filename(selected_logo)).resolve())
 
-        session.add(p); session.commit()
+        session.add(p)
+        _sync_receipt_printer(session, p.id, p.host, p.port, p.enabled)
+        session.commit()
     return RedirectResponse(url="/admin/receipts", status_code=303)
 
 @router.post("/admin/receipts/printer/delete")
 def delete_printer(session: SessionDep, printer_id: int = Form(...)):
     p = session.get(Printer, printer_id)
     if p:
-        session.delete(p); session.commit()
+        session.delete(p)
+        _sync_receipt_printer(session, printer_id, p.host, p.port, False)
+        session.commit()
     return RedirectResponse(url="/admin/receipts", status_code=303)
 
 # ---------- PREVIEW ----------
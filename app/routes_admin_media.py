@@ -7,16 +7,16 @@ import shutil, uuid
 
 from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy import delete
 from sqlmodel import Session, select
 
 from .db import get_session_dep
 from .models_media import MediaAsset, MediaType, Playlist, PlaylistItem
+from .templating import make_templates
 
 router = APIRouter()
 
-templates = Jinja2Templates(directory="app/templates")
+templates = make_templates()
 UPLOAD_DIR = Path("app/static/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
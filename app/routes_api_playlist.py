@@ -3,7 +3,7 @@ from __future__ import annotations
 
 from typing import Annotated
 from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from sqlmodel import select, Session
 
 from .db import get_session_dep
@@ -17,7 +17,7 @@ SessionDep = Annotated[Session, Depends(get_session_dep)]
 def get_playlist(plname: str, db: SessionDep):
     pl = db.exec(select(Playlist).where(Playlist.name == plname)).first()
     if not pl:
-        return JSONResponse({"version": 0, "items": []}, headers={"Cache-Control": "no-store, max-age=0"})
+        return ORJSONResponse({"version": 0, "items": []}, headers={"Cache-Control": "no-store, max-age=0"})
 
     rows = db.exec(
         select(PlaylistItem, MediaAsset)
@@ -36,7 +36,7 @@ def get_playlist(plname: str, db: SessionDep):
         for it, m in rows
     ]
 
-    return JSONResponse(
+    return ORJSONResponse(
         {"version": pl.version, "items": items},
         headers={"Cache-Control": "no-store, max-age=0"}
     )
@@ -1,20 +1,23 @@
 # app/summary.py
-from typing import List, Optional, Dict, Any, Set
+from typing import Annotated, List, Optional, Dict, Any, Set
 
 from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 from sqlalchemy import or_, and_, case
 from sqlalchemy.sql import func
-from sqlmodel import select
+from sqlmodel import select, Session
 
-from .db import get_db
+from .db import get_session_dep
 # ⬇️ ADATTA questi import ai tuoi modelli reali
 from .models import Kitchen, Order, OrderLine, Product  # noqa: F401
 
 router = APIRouter(prefix="/kds", tags=["kds"])
 
+# Dipendenza tipizzata
+SessionDep = Annotated[Session, Depends(get_session_dep)]
+
 # Stati considerati "attivi" (da preparare/in preparazione)
 DEFAULT_INCLUDE_STATES: Set[str] = {
     "queue", "queued", "inqueue", "in_queue", "waiting",
@@ -52,7 +55,7 @@ def _norm_csv(csv: Optional[str]) -> Optional[Set[str]]:
 @router.get("/{prefix}/summary", response_model=List[ProductSummary])
 def kds_summary(
     prefix: str,
-    session = Depends(get_db),
+    session: SessionDep,
     debug: int = Query(0, ge=0, le=1, description="1 per output diagnostico"),
     states: Optional[str] = Query(None, description="Stati 'attivi' da includere (CSV)"),
     exclude_states: Optional[str] = Query(None, description="Stati da escludere (CSV)"),
@@ -71,7 +74,7 @@ def kds_summary(
     ).first()
     if not kitchen:
         if debug:
-            return JSONResponse({"prefix": prefix.upper(), "error": "kitchen_not_found", "rows": []})
+            return ORJSONResponse({"prefix": prefix.upper(), "error": "kitchen_not_found", "rows": []})
         raise HTTPException(status_code=404, detail=f"Kitchen '{prefix}' non trovata")
 
     # 2) Qty "da fare"
@@ -199,7 +202,7 @@ def kds_summary(
             for st, cnt in session.exec(sc_base):
                 status_counts[st] = int(cnt)
 
-        return JSONResponse({
+        return ORJSONResponse({
             "prefix": prefix.upper(),
             "kitchen_id": int(kitchen.id),
             "kitchen_name": getattr(kitchen, "name", prefix.upper()),
@@ -0,0 +1,30 @@
+# app/templating.py
+# Jinja2Templates condiviso dalle view: un solo Environment per tutta l'app,
+# template compilati una volta sola (niente stat() del file a ogni render) e
+# bytecode salvato su disco, così anche il primo render dopo un riavvio non
+# ricompila da zero.
+# Per lo sviluppo: CALCIONE_TEMPLATES_RELOAD=1 riattiva il ricaricamento automatico.
+from __future__ import annotations
+
+import os
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+
+from .paths import TEMPLATES_DIR
+
+AUTO_RELOAD = os.getenv("CALCIONE_TEMPLATES_RELOAD", "").strip() in ("1", "true", "yes", "on")
+
+# FileSystemBytecodeCache senza argomenti: cartella per utente nella tmp,
+# creata con permessi 0700 e verificata come nostra prima di caricarci bytecode
+_ENV = Environment(
+    loader=FileSystemLoader(str(TEMPLATES_DIR)),
+    autoescape=select_autoescape(),
+    auto_reload=AUTO_RELOAD,
+    cache_size=400,
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+
+
+def make_templates() -> Jinja2Templates:
+    return Jinja2Templates(env=_ENV)
@@ -2,34 +2,68 @@
 from __future__ import annotations
 
 import csv
-import secrets
+import hashlib
+from collections import defaultdict
+from dataclasses import dataclass
 from datetime import datetime, date, time, timedelta
 from io import StringIO
 from pathlib import Path
+from time import monotonic
 from typing import Optional, Annotated
 
+import aiofiles
 from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException, Query, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy import func as sa_func, desc, update, delete
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from sqlalchemy import func as sa_func, desc, update, delete, exists, tuple_, cast, String
 from sqlmodel import select, func, Session
 
-from .db import get_session_dep
+from .cache import kitchens_map, invalidate_catalog, invalidate_kitchens, invalidate_prompts, bump_tickets_version
+from .db import get_session_dep, engine, group_concat
 from .models import Kitchen, Product, Order, OrderLine, Ticket, Category
 from .models_customizations import ProductPrompt
 from .paths import STATIC_DIR, UPLOADS_DIR
 from .printing import print_kitchen_receipt, print_category_receipt
+from .templating import make_templates
 
 # Dipendenza tipizzata per chiarezza
 SessionDep = Annotated[Session, Depends(get_session_dep)]
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+templates = make_templates()
+
+# Intestazione CSV costante: formattata una volta sola a import
+_CSV_HEADER = "order_id,created_at_utc,paid_method,total_cents,product,qty,price_cents,kitchen_prefix\r\n"
 
 # ---------------------------------------------------------------------------
 # Storico ordini (admin)
 # ---------------------------------------------------------------------------
 
+_DAY_START = time(0, 0, 0)
+_DAY_END = time(23, 59, 59)
+_ONE_DAY = timedelta(days=1)
+_ONE_SEC = timedelta(seconds=1)
+
+def _parse_range(
+    start: Optional[str], end: Optional[str], start_time: Optional[str], end_time: Optional[str]
+) -> tuple[date, date, time, time, datetime, datetime]:
+    """Filtri data/ora -> (start_d, end_d, start_t, end_t, dt_from, dt_to_ex); default: oggi intero."""
+    today = date.today()
+    if not (start or end or start_time or end_time):
+        # caso comune (nessun filtro): niente parsing
+        dt_from = datetime.combine(today, _DAY_START)
+        return today, today, _DAY_START, _DAY_END, dt_from, dt_from + _ONE_DAY
+
+    start_d = date.fromisoformat(start) if start else today
+    end_d   = date.fromisoformat(end)   if end   else today
+
+    start_t = time.fromisoformat(start_time) if start_time else _DAY_START
+    end_t   = time.fromisoformat(end_time)   if end_time   else _DAY_END
+
+    dt_from = datetime.combine(start_d, start_t)
+    dt_to_ex = datetime.combine(end_d, end_t) + _ONE_SEC  # esclusivo
+    return start_d, end_d, start_t, end_t, dt_from, dt_to_ex
+
 @router.get("/admin/orders", response_class=HTMLResponse)
 def admin_orders(
     request: Request,
@@ -39,81 +73,62 @@ def admin_orders(
     start_time: Optional[str] = Query(None, description="HH:MM"),
     end_time: Optional[str] = Query(None, description="HH:MM"),
     limit: int = Query(300, ge=1, le=2000),
+    before_ts: Optional[datetime] = Query(None, description="keyset: created_at dell'ultimo ordine visto"),
+    before_id: Optional[int] = Query(None, description="keyset: id dell'ultimo ordine visto"),
 ):
     """Storico ordini con filtro data+ora. Default: oggi 00:00 -> oggi 23:59:59."""
-    today = date.today()
-    start_d = datetime.strptime(start, "%Y-%m-%d").date() if start else today
-    end_d   = datetime.strptime(end,   "%Y-%m-%d").date() if end   else today
-
-    start_t = datetime.strptime(start_time, "%H:%M").time() if start_time else time(0, 0, 0)
-    end_t   = datetime.strptime(end_time,   "%H:%M").time() if end_time   else time(23, 59, 59)
-
-    dt_from = datetime.combine(start_d, start_t)
-    dt_to_ex = datetime.combine(end_d, end_t) + timedelta(seconds=1)  # esclusivo
+    start_d, end_d, start_t, end_t, dt_from, dt_to_ex = _parse_range(start, end, start_time, end_time)
 
-    # Ordini nel range
+    # Ordini nel range, paginati per chiave (created_at, id) sull'indice composito:
+    # la pagina successiva riparte dall'ultimo ordine visto invece di riscandire il range
+    conds = [Order.created_at >= dt_from, Order.created_at < dt_to_ex]
+    if before_ts is not None and before_id is not None:
+        conds.append(tuple_(Order.created_at, Order.id) < tuple_(before_ts, before_id))
     orders = session.exec(
         select(Order)
-        .where(Order.created_at >= dt_from, Order.created_at < dt_to_ex)
-        .order_by(Order.created_at.desc())
+        .where(*conds)
+        .order_by(Order.created_at.desc(), Order.id.desc())
         .limit(limit)
     ).all()
 
-    order_ids = [int(o.id) for o in orders]
-    items_by_order: dict[int, list[tuple[str, int]]] = {}
+    order_ids = [o.id for o in orders]
+    items_by_order: defaultdict[int, list[tuple[str, int]]] = defaultdict(list)
     ticket_labels_by_order: dict[int, str] = {}
 
     if order_ids:
-        # Righe ordine
+        # Riepilogo per ordine (compresso per nome) calcolato in SQL:
+        # nome prodotto con fallback "Prod #id", somma qty, già ordinato per nome
+        name_expr = func.coalesce(Product.name, "Prod #" + cast(OrderLine.product_id, String))
         lines = session.exec(
-            select(OrderLine).where(OrderLine.order_id.in_(order_ids))
+            select(OrderLine.order_id, name_expr, func.sum(OrderLine.qty))
+            .outerjoin(Product, Product.id == OrderLine.product_id)
+            .where(OrderLine.order_id.in_(order_ids))
+            .group_by(OrderLine.order_id, name_expr)
+            .order_by(OrderLine.order_id, func.lower(name_expr))
         ).all()
 
-        # Mappa prodotti
-        prod_ids = list({int(l.product_id) for l in lines})
-        products_map = {
-            int(p.id): p
-            for p in session.exec(select(Product).where(Product.id.in_(prod_ids))).all()
-        } if prod_ids else {}
-
-        # Riepilogo per ordine (compresso per nome)
-        tmp_rows: dict[int, list[tuple[str, int]]] = {}
-        for l in lines:
-            pid = int(l.product_id)
-            oid = int(l.order_id)
-            name = products_map.get(pid).name if products_map.get(pid) else f"Prod #{pid}"
-            tmp_rows.setdefault(oid, []).append((name, int(l.qty or 0)))
-
-        for oid, rows in tmp_rows.items():
-            acc: dict[str, int] = {}
-            for nm, q in rows:
-                acc[nm] = acc.get(nm, 0) + q
-            items_by_order[oid] = sorted(acc.items(), key=lambda x: x[0].lower())
-
-        # Ticket -> etichette "PREFISSO-SEQ", senza JOIN (robusto)
-        tks = session.exec(
-            select(Ticket).where(Ticket.order_id.in_(order_ids))
-        ).all()
-        kitchens_map = {int(k.id): k for k in session.exec(select(Kitchen)).all()}
-
-        tk_acc: dict[int, set[tuple[str, int]]] = {}
-        for tk in tks:
-            if tk.pickup_seq is None:
-                continue
-            k = kitchens_map.get(int(tk.kitchen_id)) if tk.kitchen_id is not None else None
-            if not k:
-                continue
-            pref = (k.prefix or "").upper().strip()
-            seq  = int(tk.pickup_seq)
-            if not pref:
-                continue
-            oid = int(tk.order_id)
-            tk_acc.setdefault(oid, set()).add((pref, seq))
-
-        for oid, pairs in tk_acc.items():
-            ordered = sorted(pairs, key=lambda p: (p[0], p[1]))  # per prefisso, poi seq
-            labels = [f"{p}-{s}" for (p, s) in ordered]
-            ticket_labels_by_order[oid] = ", ".join(labels)
+        for oid, nm, q in lines:
+            items_by_order[oid].append((nm, q or 0))
+
+        # Ticket -> etichette "PREFISSO-SEQ, ..." composte direttamente in SQL:
+        # coppie distinte (prefisso, seq) ordinate, poi concatenate per ordine
+        pref_expr = func.upper(func.trim(Kitchen.prefix), type_=String)
+        pairs = (
+            select(Ticket.order_id, pref_expr.label("pref"), Ticket.pickup_seq)
+            .distinct()
+            .join(Kitchen, Kitchen.id == Ticket.kitchen_id)
+            .where(
+                Ticket.order_id.in_(order_ids),
+                Ticket.pickup_seq.is_not(None),
+                func.length(pref_expr) > 0,
+            )
+            .order_by(Ticket.order_id, "pref", Ticket.pickup_seq)
+            .subquery()
+        )
+        label = pairs.c.pref + "-" + cast(pairs.c.pickup_seq, String)
+        ticket_labels_by_order = dict(session.exec(
+            select(pairs.c.order_id, group_concat(label, ", ", pairs.c.pref, pairs.c.pickup_seq)).group_by(pairs.c.order_id)
+        ).all())
 
     return templates.TemplateResponse(
         "admin_orders.html",
@@ -127,6 +142,8 @@ def admin_orders(
             "end_time": end_t.strftime("%H:%M"),
             "limit": limit,
             "total_count": len(orders),
+            # Pagina piena: probabilmente ci sono ordini più vecchi
+            "next_before": (orders[-1].created_at.isoformat(), orders[-1].id) if len(orders) == limit else None,
             "ticket_labels_by_order": ticket_labels_by_order,
         },
     )
@@ -135,25 +152,18 @@ def admin_orders(
 # Sales
 # ---------------------------------------------------------------------------
 
-@router.get("/admin/sales", response_class=HTMLResponse)
-def admin_sales(request: Request, session: SessionDep):
-    qs = request.query_params
-
-    start_date_s = qs.get("start_date")  # "YYYY-MM-DD"
-    end_date_s   = qs.get("end_date")    # "YYYY-MM-DD"
-    start_time_s = qs.get("start_time")  # "HH:MM"
-    end_time_s   = qs.get("end_time")    # "HH:MM"
-
-    today = date.today()
-    start_d = date.fromisoformat(start_date_s) if start_date_s else today
-    end_d   = date.fromisoformat(end_date_s)   if end_date_s   else today
-
-    start_t = time.fromisoformat(start_time_s) if start_time_s else time(0, 0, 0)
-    end_t   = time.fromisoformat(end_time_s)   if end_time_s   else time(23, 59, 59)
+# Micro-cache aggregati vendite (assorbe i refresh ravvicinati della dashboard)
+_SALES_CACHE: dict[tuple[datetime, datetime], tuple[float, int, tuple]] = {}
+_SALES_CACHE_TTL = 5.0  # secondi
+_SALES_CACHE_MAX = 64
 
-    start_dt = datetime.combine(start_d, start_t)
-    end_dt   = datetime.combine(end_d, end_t)
-    end_dt_exclusive = end_dt + timedelta(seconds=1)
+def _sales_for(session: Session, start_dt: datetime, end_dt_exclusive: datetime) -> tuple[int, tuple]:
+    """(totale, righe per prodotto) nel range [start_dt, end_dt_exclusive), con TTL breve."""
+    key = (start_dt, end_dt_exclusive)
+    now = monotonic()
+    hit = _SALES_CACHE.get(key)
+    if hit and (now - hit[0] < _SALES_CACHE_TTL):
+        return hit[1], hit[2]
 
     total_cents = session.exec(
         select(func.coalesce(func.sum(Order.total_cents), 0))
@@ -161,7 +171,7 @@ def admin_sales(request: Request, session: SessionDep):
         .where(Order.created_at < end_dt_exclusive)
     ).one()
 
-    rows = session.exec(
+    rows = tuple(session.exec(
         select(
             Product.name.label("product"),
             func.coalesce(func.sum(OrderLine.qty), 0).label("qty"),
@@ -173,7 +183,27 @@ def admin_sales(request: Request, session: SessionDep):
         .where(Order.created_at < end_dt_exclusive)
         .group_by(Product.id, Product.name)
         .order_by(desc("qty"))
-    ).all()
+    ).all())
+
+    if len(_SALES_CACHE) >= _SALES_CACHE_MAX:
+        _SALES_CACHE.clear()
+    _SALES_CACHE[key] = (now, total_cents or 0, rows)
+    return total_cents or 0, rows
+
+@router.get("/admin/sales", response_class=HTMLResponse)
+def admin_sales(request: Request, session: SessionDep):
+    qs = request.query_params
+
+    start_date_s = qs.get("start_date")  # "YYYY-MM-DD"
+    end_date_s   = qs.get("end_date")    # "YYYY-MM-DD"
+    start_time_s = qs.get("start_time")  # "HH:MM"
+    end_time_s   = qs.get("end_time")    # "HH:MM"
+
+    start_d, end_d, start_t, end_t, start_dt, end_dt_exclusive = _parse_range(
+        start_date_s, end_date_s, start_time_s, end_time_s
+    )
+
+    total_cents, rows = _sales_for(session, start_dt, end_dt_exclusive)
 
     return templates.TemplateResponse(
         "admin_sales.html",
@@ -233,13 +263,18 @@ def admin_product_prompts_save(
         rows.append((nm, kd, req_bool, ch_list, dc))
 
     session.exec(ProductPrompt.__table__.delete().where(ProductPrompt.product_id == product_id))
-    for (nm, kd, req, ch_list, dc) in rows:
-        session.add(ProductPrompt(
-            product_id=product_id,
-            name=nm, kind=kd, required=req,
-            choices=ch_list, delta_cents=dc,
-        ))
+    if rows:
+        # un solo INSERT multi-riga (executemany), senza passare dall'unit-of-work ORM
+        session.execute(ProductPrompt.__table__.insert(), [
+            {
+                "product_id": product_id,
+                "name": nm, "kind": kd, "required": req,
+                "choices": ch_list, "delta_cents": dc,
+            }
+            for (nm, kd, req, ch_list, dc) in rows
+        ])
     session.commit()
+    invalidate_prompts(product_id)
 
     return RedirectResponse(url="/admin?ok=1", status_code=303)
 
@@ -253,8 +288,7 @@ def admin_print_test(session: SessionDep):
     products = session.exec(select(Product).limit(3)).all()
     demo_lines = [(p.name, 1) for p in products] if products else [("Prodotto demo A", 1), ("Prodotto demo B", 2)]
 
-    kitchens = session.exec(select(Kitchen)).all()
-    for k in kitchens:
+    for k in kitchens_map(session).values():
         try:
             print_kitchen_receipt(k.prefix, 999, demo_lines)
         except Exception as e:
@@ -273,27 +307,43 @@ def admin_print_test(session: SessionDep):
 # Admin main page
 # ---------------------------------------------------------------------------
 
+@dataclass(slots=True)
+class PromptView:
+    """Vista di un ProductPrompt per il template admin (choices già in CSV)."""
+    id: int
+    name: str
+    kind: str
+    required: bool
+    choices_csv: str
+    price_delta_cents: int
+
 @router.get("/admin", response_class=HTMLResponse)
 def admin_page(request: Request, session: SessionDep):
     kitchens = session.exec(select(Kitchen).order_by(Kitchen.prefix.asc())).all()
-    products = session.exec(select(Product).order_by(Product.name)).all()
     categories = session.exec(select(Category).order_by(Category.name)).all()
 
-    # customizzazioni per tutti i prodotti
-    prompts_by_product = {}
-    if products:
-        pids = [p.id for p in products]
-        rows = session.exec(select(ProductPrompt).where(ProductPrompt.product_id.in_(pids))).all()
-        for r in rows:
-            choices_csv = "; ".join(r.choices or []) if r.choices else ""
-            prompts_by_product.setdefault(r.product_id, []).append(type("X", (), {
-                "id": r.id,
-                "name": r.name,
-                "kind": r.kind,
-                "required": bool(r.required),
-                "choices_csv": choices_csv,
-                "price_delta_cents": int(r.delta_cents or 0),
-            }))
+    # prodotti + customizzazioni in un solo giro (LEFT JOIN, righe contigue per prodotto)
+    products: list[Product] = []
+    prompts_by_product: dict[int, list[PromptView]] = {}
+    rows = session.exec(
+        select(Product, ProductPrompt)
+        .outerjoin(ProductPrompt, ProductPrompt.product_id == Product.id)
+        .order_by(Product.name, Product.id, ProductPrompt.id)
+    ).all()
+    for p, r in rows:
+        if not products or products[-1].id != p.id:
+            products.append(p)
+        if r is None:
+            continue
+        choices_csv = "; ".join(r.choices or []) if r.choices else ""
+        prompts_by_product.setdefault(r.product_id, []).append(PromptView(
+            id=r.id,
+            name=r.name,
+            kind=r.kind,
+            required=bool(r.required),
+            choices_csv=choices_csv,
+            price_delta_cents=int(r.delta_cents or 0),
+        ))
     return templates.TemplateResponse(
         "admin.html",
         {
@@ -321,6 +371,7 @@ def _int_or_none(v):
 def admin_category_add(session: SessionDep, name: str = Form(...), kitchen_id: str | None = Form(None)):
     session.add(Category(name=name.strip(), kitchen_id=_int_or_none(kitchen_id)))
     session.commit()
+    invalidate_catalog()
     return RedirectResponse(url="/admin?cat_added=1", status_code=303)
 
 @router.post("/admin/category/delete")
@@ -329,6 +380,7 @@ def admin_category_delete(session: SessionDep, category_id: int = Form(...)):
     if cat:
         session.delete(cat)
         session.commit()
+        invalidate_catalog()
     return RedirectResponse(url="/admin?cat_deleted=1", status_code=303)
 
 @router.post("/admin/category/update-kitchen")
@@ -338,6 +390,7 @@ def admin_category_update_kitchen(session: SessionDep, category_id: int = Form(.
         cat.kitchen_id = _int_or_none(kitchen_id)
         session.add(cat)
         session.commit()
+        invalidate_catalog()
     return RedirectResponse(url="/admin?cat_updated=1", status_code=303)
 
 @router.post("/admin/category/update", include_in_schema=False)
@@ -357,14 +410,34 @@ def admin_category_update(
     c.color_hex = color if color.startswith("#") and len(color) in (4, 7) else "#0ea5e9"
     session.add(c)
     session.commit()
+    invalidate_catalog()
     return RedirectResponse("/admin?cat_updated=1", status_code=303)
 
 # ---------------------------------------------------------------------------
 # Prodotti
 # ---------------------------------------------------------------------------
 
+# Add/update sono async solo per leggere l'upload a blocchi: la parte DB è
+# sincrona e gira nel threadpool (come le azioni KDS), non sull'event loop.
+
+def _product_add_db(session: Session, fields: dict) -> None:
+    session.add(Product(**fields))
+    session.commit()
+    invalidate_catalog()
+
+def _product_update_db(session: Session, product_id: int, fields: dict) -> bool:
+    p = session.get(Product, product_id)
+    if not p:
+        return False
+    for k, v in fields.items():
+        setattr(p, k, v)
+    session.add(p)
+    session.commit()
+    invalidate_catalog()
+    return True
+
 @router.post("/admin/product/add")
-def admin_product_add(
+async def admin_product_add(
     session: SessionDep,
     name: str = Form(...),
     price_eur: float = Form(...),
@@ -374,21 +447,20 @@ def admin_product_add(
     image_file: UploadFile | None = File(None),
 ):
     price_cents = int(round(price_eur * 100))
-    uploaded = _save_image_file(image_file)
+    uploaded = await _save_image_file(image_file)
     final_image = uploaded or (image_url.strip() if image_url else None)
 
-    session.add(Product(
-        name=name.strip(),
-        price_cents=price_cents,
-        kitchen_id=_int_or_none(kitchen_id),
-        category_id=_int_or_none(category_id),
-        image_url=final_image,
-    ))
-    session.commit()
+    await run_in_threadpool(_product_add_db, session, {
+        "name": name.strip(),
+        "price_cents": price_cents,
+        "kitchen_id": _int_or_none(kitchen_id),
+        "category_id": _int_or_none(category_id),
+        "image_url": final_image,
+    })
     return RedirectResponse(url="/admin?ok=1", status_code=303)
 
 @router.post("/admin/product/update")
-def admin_product_update(
+async def admin_product_update(
     session: SessionDep,
     product_id: int = Form(...),
     name: str = Form(...),
@@ -399,24 +471,25 @@ def admin_product_update(
     image_file: UploadFile | None = File(None),
 ):
     price_cents = int(round(float(price_eur) * 100))
-    p = session.get(Product, product_id)
-    if not p:
+    # 404 prima di salvare l'eventuale immagine
+    if not await run_in_threadpool(session.get, Product, product_id):
         raise HTTPException(status_code=404, detail="Prodotto non trovato")
 
-    p.name = name.strip()
-    p.price_cents = price_cents
-    p.kitchen_id = _int_or_none(kitchen_id)
-    p.category_id = _int_or_none(category_id)
-
-    uploaded = _save_image_file(image_file)
+    fields = {
+        "name": name.strip(),
+        "price_cents": price_cents,
+        "kitchen_id": _int_or_none(kitchen_id),
+        "category_id": _int_or_none(category_id),
+    }
+    uploaded = await _save_image_file(image_file)
     if uploaded:
-        p.image_url = uploaded
+        fields["image_url"] = uploaded
     else:
         if image_url is not None:
-            p.image_url = (image_url.strip() or None)
+            fields["image_url"] = (image_url.strip() or None)
 
-    session.add(p)
-    session.commit()
+    if not await run_in_threadpool(_product_update_db, session, product_id, fields):
+        raise HTTPException(status_code=404, detail="Prodotto non trovato")
     return RedirectResponse(url="/admin?updated=1", status_code=303)
 
 @router.post("/admin/product/delete")
@@ -425,21 +498,35 @@ def admin_product_delete(session: SessionDep, product_id: int = Form(...)):
     if p:
         session.delete(p)
         session.commit()
+        invalidate_catalog()
+        invalidate_prompts(product_id)
     return RedirectResponse(url="/admin?deleted=1", status_code=303)
 
-def _save_image_file(image_file: UploadFile | None) -> str | None:
-    """Salva il file immagine su /static/uploads e ritorna l'URL /static/uploads/xxx oppure None."""
+_UPLOAD_CHUNK = 1 << 20  # 1 MB
+
+async def _save_image_file(image_file: UploadFile | None) -> str | None:
+    """Salva il file immagine su /static/uploads (a blocchi, async) e ritorna l'URL /static/uploads/xxx oppure None."""
     if not image_file or not image_file.filename:
         return None
     if not (image_file.content_type or "").startswith("image/"):
         raise HTTPException(status_code=400, detail="Il file caricato non è un'immagine")
 
+    # Nome = hash del contenuto: la stessa immagine ricaricata non viene riscritta
+    h = hashlib.blake2b(digest_size=16)
+    while chunk := await image_file.read(_UPLOAD_CHUNK):
+        h.update(chunk)
     suffix = Path(image_file.filename).suffix.lower() or ".png"
-    name = f"{secrets.token_hex(8)}{suffix}"
+    name = f"{h.hexdigest()}{suffix}"
     UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
     dest = UPLOADS_DIR / name
-    with dest.open("wb") as f:
-        f.write(image_file.file.read())
+    if not dest.exists():
+        # scrittura su file temporaneo + rename: mai un file a metà col nome "buono"
+        tmp = dest.with_name(f".{name}.part")
+        await image_file.seek(0)
+        async with aiofiles.open(tmp, "wb") as f:
+            while chunk := await image_file.read(_UPLOAD_CHUNK):
+                await f.write(chunk)
+        tmp.replace(dest)
     return f"/static/uploads/{name}"
 
 # ---------------------------------------------------------------------------
@@ -458,35 +545,39 @@ def admin_kitchen_add(session: SessionDep, name: str = Form(...), prefix: str =
         exists.name = name
         session.add(exists)
         session.commit()
+        invalidate_kitchens()
         return RedirectResponse(url="/admin?kit_msg=updated", status_code=303)
 
     k = Kitchen(name=name, prefix=prefix, next_seq=1)
     session.add(k)
     session.commit()
+    invalidate_kitchens()
     return RedirectResponse(url="/admin?kit_msg=created", status_code=303)
 
 @router.post("/admin/kitchen/delete")
 def delete_kitchen(session: SessionDep, kitchen_id: int = Form(...)):
-    k = session.get(Kitchen, kitchen_id)
-    if not k:
-        return RedirectResponse("/admin?kdel_missing=1", status_code=303)
+    # Tutto in un'unica transazione: un solo commit (e un solo fsync) per ogni esito
+    with session.begin():
+        k = session.get(Kitchen, kitchen_id)
+        if not k:
+            return RedirectResponse("/admin?kdel_missing=1", status_code=303)
 
-    # 1) Scollega prodotti/categorie
-    session.exec(update(Product).where(Product.kitchen_id == kitchen_id).values(kitchen_id=None))
-    session.exec(update(Category).where(Category.kitchen_id == kitchen_id).values(kitchen_id=None))
+        # 1) Scollega prodotti/categorie
+        session.exec(update(Product).where(Product.kitchen_id == kitchen_id).values(kitchen_id=None))
+        session.exec(update(Category).where(Category.kitchen_id == kitchen_id).values(kitchen_id=None))
 
-    # 2) Cancella ticket 'delivered'
-    session.exec(delete(Ticket).where(Ticket.kitchen_id == kitchen_id, Ticket.status == "delivered"))
+        # 2) Cancella ticket 'delivered'
+        session.exec(delete(Ticket).where(Ticket.kitchen_id == kitchen_id, Ticket.status == "delivered"))
 
-    # 3) Verifica ticket non consegnati
-    remaining = session.exec(select(Ticket.id).where(Ticket.kitchen_id == kitchen_id)).first()
-    if remaining:
-        session.commit()
-        return RedirectResponse("/admin?kdel_block_active=1", status_code=303)
+        # 3) Verifica ticket non consegnati (EXISTS: niente riga da materializzare)
+        remaining = session.exec(select(exists().where(Ticket.kitchen_id == kitchen_id))).one()
+        if remaining:
+            return RedirectResponse("/admin?kdel_block_active=1", status_code=303)
 
-    # 4) Elimina kitchen
-    session.delete(k)
-    session.commit()
+        # 4) Elimina kitchen
+        session.delete(k)
+
+    invalidate_kitchens()
     return RedirectResponse("/admin?kdel_ok=1", status_code=303)
 
 # ---------------------------------------------------------------------------
@@ -505,12 +596,14 @@ def admin_seq_reset(session: SessionDep, kitchen_id: int = Form(...)):
 @router.post("/admin/seq/align")
 def admin_seq_align(session: SessionDep, kitchen_id: int = Form(...)):
     """Imposta next_seq a (max(pickup_seq) + 1) per quella cucina."""
-    k = session.get(Kitchen, kitchen_id)
-    if k:
-        max_seq = session.exec(select(func.max(Ticket.pickup_seq)).where(Ticket.kitchen_id == k.id)).one()
-        k.next_seq = (max_seq or 0) + 1
-        session.add(k)
-        session.commit()
+    # Un solo UPDATE con subquery: niente SELECT separata né round-trip extra
+    max_seq = (
+        select(func.coalesce(func.max(Ticket.pickup_seq), 0) + 1)
+        .where(Ticket.kitchen_id == kitchen_id)
+        .scalar_subquery()
+    )
+    session.exec(update(Kitchen).where(Kitchen.id == kitchen_id).values(next_seq=max_seq))
+    session.commit()
     return RedirectResponse(url="/admin?seq_align=1", status_code=303)
 
 # ---------------------------------------------------------------------------
@@ -520,66 +613,80 @@ def admin_seq_align(session: SessionDep, kitchen_id: int = Form(...)):
 @router.post("/admin/close_day")
 def admin_close_day(session: SessionDep):
     """Tutti i ticket -> delivered e azzero numerazioni."""
-    tickets = session.exec(select(Ticket).where(Ticket.status != "delivered")).all()
-    for t in tickets:
-        t.status = "delivered"  # type: ignore
-        session.add(t)
-    for k in session.exec(select(Kitchen)).all():
-        k.next_seq = 1
-        session.add(k)
-    session.commit()
+    with session.begin():
+        session.exec(update(Ticket).where(Ticket.status != "delivered").values(status="delivered"))
+        session.exec(update(Kitchen).values(next_seq=1))
+    bump_tickets_version()
     return RedirectResponse(url="/admin?closed=1", status_code=303)
 
 @router.post("/admin/clear_delivered")
 def admin_clear_delivered(session: SessionDep):
     """Pulisce tutti i ticket marcati delivered (mantiene i dati ordini)."""
-    delivered = session.exec(select(Ticket).where(Ticket.status == "delivered")).all()
-    for t in delivered:
-        session.delete(t)
-    session.commit()
+    with session.begin():
+        session.exec(delete(Ticket).where(Ticket.status == "delivered"))
+    bump_tickets_version()
     return RedirectResponse(url="/admin?cleared=1", status_code=303)
 
 # ---------------------------------------------------------------------------
 # Export CSV
 # ---------------------------------------------------------------------------
 
-@router.get("/admin/export.csv", response_class=PlainTextResponse)
+@router.get("/admin/export.csv", response_class=StreamingResponse)
 def admin_export_csv(
-    session: SessionDep,
     start: date = Query(..., description="YYYY-MM-DD"),
     end: date = Query(..., description="YYYY-MM-DD (incluso)")
 ):
-    """Export ordini + righe in CSV per range date (UTC)."""
-    start_dt = datetime.combine(start, datetime.min.time())
-    end_dt = datetime.combine(end, datetime.max.time())
-
-    out = StringIO()
-    w = csv.writer(out)
-    w.writerow(["order_id", "created_at_utc", "paid_method", "total_cents", "product", "qty", "price_cents", "kitchen_prefix"])
-
-    orders = session.exec(select(Order).where(Order.created_at >= start_dt, Order.created_at <= end_dt)).all()
-    kitchens = {k.id: k for k in session.exec(select(Kitchen)).all()}
-    products = {p.id: p for p in session.exec(select(Product)).all()}
-
-    for o in orders:
-        lines = session.exec(select(OrderLine).where(OrderLine.order_id == o.id)).all()
-        for ln in lines:
-            p = products.get(ln.product_id)
-            k = kitchens.get(ln.kitchen_id)
-            w.writerow([
-                o.id,
-                o.created_at.isoformat(),
-                o.paid_method,
-                o.total_cents,
-                p.name if p else "",
-                ln.qty,
-                p.price_cents if p else "",
-                k.prefix if k else "",
-            ])
-
-    csv_data = out.getvalue()
+    """Export ordini + righe in CSV per range date (UTC), in streaming."""
+    start_dt = datetime.combine(start, time.min)
+    end_dt_exclusive = datetime.combine(end + timedelta(days=1), time.min)  # esclusivo
+
+    # Una sola query: righe + ordine + prodotto + postazione, niente N+1
+    stmt = (
+        select(
+            Order.id,
+            Order.created_at,
+            Order.paid_method,
+            Order.total_cents,
+            Product.name,
+            OrderLine.qty,
+            Product.price_cents,
+            Kitchen.prefix,
+        )
+        .select_from(OrderLine)
+        .join(Order, Order.id == OrderLine.order_id)
+        .outerjoin(Product, Product.id == OrderLine.product_id)
+        .outerjoin(Kitchen, Kitchen.id == OrderLine.kitchen_id)
+        .where(Order.created_at >= start_dt, Order.created_at < end_dt_exclusive)
+        .order_by(Order.id, OrderLine.id)
+        .execution_options(yield_per=1000)
+    )
+
+    def gen():
+        yield _CSV_HEADER
+        buf = StringIO()
+        w = csv.writer(buf)
+        # Sessione propria: quella della dipendenza è già chiusa quando parte lo streaming
+        with Session(engine) as session:
+            for batch in session.exec(stmt).partitions():
+                w.writerows(
+                    (
+                        oid,
+                        created_at.isoformat(),
+                        paid_method,
+                        total_cents,
+                        p_name if p_name is not None else "",
+                        qty,
+                        p_price if p_price is not None else "",
+                        k_prefix if k_prefix is not None else "",
+                    )
+                    for oid, created_at, paid_method, total_cents, p_name, qty, p_price, k_prefix in batch
+                )
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate(0)
+
     headers = {"Content-Disposition": f'attachment; filename="export_{start}_{end}.csv"'}
-    return PlainTextResponse(csv_data, headers=headers)
+    return StreamingResponse(gen(), media_type="text/csv", headers=headers)
 
 # ---------------------------------------------------------------------------
 # Utility fix
@@ -595,4 +702,5 @@ def unlink_products_categories(session: SessionDep, kitchen_id: int = Form(...))
     session.exec(update(Product).where(Product.kitchen_id == kitchen_id).values(kitchen_id=None))
     session.exec(update(Category).where(Category.kitchen_id == kitchen_id).values(kitchen_id=None))
     session.commit()
+    invalidate_catalog()
     return RedirectResponse("/admin?kfix_unlinked=1", status_code=303)
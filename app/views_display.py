@@ -6,104 +6,169 @@ from time import time
 from typing import Annotated
 
 from fastapi import APIRouter, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from sqlalchemy import cast, String
 from sqlmodel import select, Session
 
-from .db import get_session_dep
+from .cache import kitchens_list, kitchens_map, request_memo, tickets_version
+from .db import get_session_dep, group_concat
 from .models import Kitchen, Ticket, Order, OrderLine
+from .templating import make_templates
 
 # Dipendenza tipizzata
 SessionDep = Annotated[Session, Depends(get_session_dep)]
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+templates = make_templates()
+# Fragment in polling: Template risolto una volta sola e renderizzato direttamente
+_TPL_DISPLAY_FRAGMENT = templates.get_template("display_fragment.html")
 
 # ------- piccola cache per Kitchen by prefix (riduce query durante il polling) -------
-_KCACHE: dict[str, dict[str, object]] = {}
+# Valori (scadenza, kitchen): sul percorso caldo un solo get + un confronto
+_KCACHE: dict[str, tuple[float, Kitchen | None]] = {}
 _KCACHE_TTL = 5.0  # secondi
 
 def _kitchen_by_prefix(prefix: str, session: Session) -> Kitchen | None:
-    key = prefix.upper().strip()
+    """`prefix` va passato già normalizzato (maiuscolo)."""
+    memo = request_memo()
+    key = ("kitchen", prefix)
+    if memo is not None and key in memo:
+        return memo[key]
     now = time()
-    hit = _KCACHE.get(key)
-    if hit and (now - hit["t"] < _KCACHE_TTL):
-        return hit["v"]  # type: ignore
-    k = session.exec(select(Kitchen).where(Kitchen.prefix == key)).first()
-    _KCACHE[key] = {"v": k, "t": now}
+    hit = _KCACHE.get(prefix)
+    if hit is not None and hit[0] > now:
+        k = hit[1]
+    else:
+        k = session.exec(select(Kitchen).where(Kitchen.prefix == prefix)).first()
+        _KCACHE[prefix] = (now + _KCACHE_TTL, k)
+    if memo is not None:
+        memo[key] = k
     return k
 
+# ------- cache dei fragment HTML ---------------------------------------------------
+# Tanti schermi fanno polling sullo stesso fragment: l'HTML si rigenera solo se
+# i ticket sono cambiati (versione) o, per sicurezza, allo scadere del TTL.
+# Vale anche per le varianti JSON (/data): si salvano i byte già serializzati.
+_FRAG_CACHE: dict[tuple[str, str | None], tuple[int, float, bytes, str]] = {}
+_FRAG_CACHE_TTL = 5.0  # secondi
+
+def _cached_fragment(key: tuple[str, str | None]) -> Response | None:
+    hit = _FRAG_CACHE.get(key)
+    if hit and hit[0] == tickets_version() and time() - hit[1] < _FRAG_CACHE_TTL:
+        return Response(hit[2], media_type=hit[3], headers={"Cache-Control": "no-store"})
+    return None
+
+def _store_fragment(key: tuple[str, str | None], version: int, resp: Response) -> Response:
+    _FRAG_CACHE[key] = (version, time(), resp.body, resp.media_type)
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+def _ready_seqs_by_kitchen(session: Session) -> dict[int, list[int]]:
+    """{kitchen_id: [seq pronti, dal più alto]}: raggruppati in SQL, una riga per postazione."""
+    pairs = (
+        select(Ticket.kitchen_id, Ticket.pickup_seq)
+        .where(Ticket.status == "ready")
+        .order_by(Ticket.kitchen_id, Ticket.pickup_seq.desc())
+        .subquery()
+    )
+    rows = session.exec(
+        select(pairs.c.kitchen_id, group_concat(cast(pairs.c.pickup_seq, String), ",", pairs.c.pickup_seq.desc()))
+        .group_by(pairs.c.kitchen_id)
+    ).all()
+    return {kid: [int(s) for s in seqs.split(",")] for kid, seqs in rows}
+
+def _ready_by_prefix(session: Session) -> dict[str, list[int]]:
+    """Numeri pronti per tutte le postazioni, pannelli vuoti inclusi."""
+    ready = _ready_seqs_by_kitchen(session)
+    return {k.prefix: ready.get(k.id, []) for k in kitchens_list(session)}
+
+def _ready_seqs(kitchen: Kitchen, session: Session) -> list[int]:
+    return list(session.exec(
+        select(Ticket.pickup_seq)
+        .where(Ticket.kitchen_id == kitchen.id, Ticket.status == "ready")
+        .order_by(Ticket.pickup_seq.desc())
+    ).all())
+
 # -------------------------------------------------------------------------------------
 
 @router.get("/display", response_class=HTMLResponse)
 def display_all_page(request: Request, session: SessionDep):
     # sottomenu + vista "tutti"
-    kitchens = session.exec(select(Kitchen).order_by(Kitchen.name)).all()
+    kitchens = kitchens_list(session)
     return templates.TemplateResponse(
         "display.html",
         {"request": request, "mode": "all", "kitchen": None, "kitchens": kitchens},
     )
 
-@router.get("/display/{prefix}", response_class=HTMLResponse)
-def display_one_page(prefix: str, request: Request, session: SessionDep):
+# --- dati JSON (il display li renderizza lato client) ------------------------
+# /display/data e /display/fragment sono registrati prima di /display/{prefix},
+# che altrimenti li catturerebbe.
+
+@router.get("/display/data", response_class=ORJSONResponse)
+def display_all_data(session: SessionDep):
+    key = ("all-json", None)
+    if (cached := _cached_fragment(key)) is not None:
+        return cached
+    version = tickets_version()
+    return _store_fragment(key, version, ORJSONResponse({"mode": "all", "by_prefix": _ready_by_prefix(session)}))
+
+@router.get("/display/{prefix}/data", response_class=ORJSONResponse)
+def display_one_data(prefix: str, session: SessionDep):
     prefix = prefix.upper()
-    kitchens = session.exec(select(Kitchen).order_by(Kitchen.name)).all()
+    key = ("one-json", prefix)
+    if (cached := _cached_fragment(key)) is not None:
+        return cached
+    version = tickets_version()
+
     kitchen = _kitchen_by_prefix(prefix, session)
     if not kitchen:
-        raise HTTPException(404, f"Nessuna postazione {prefix}")
-    return templates.TemplateResponse(
-        "display.html",
-        {"request": request, "mode": "one", "kitchen": kitchen, "kitchens": kitchens},
-    )
+        return ORJSONResponse({"detail": "Postazione non trovata"}, status_code=404)
+    return _store_fragment(key, version, ORJSONResponse(
+        {"mode": "one", "prefix": prefix, "seqs": _ready_seqs(kitchen, session)}
+    ))
 
 @router.get("/display/fragment", response_class=HTMLResponse)
 def display_all_fragment(request: Request, session: SessionDep):
     # Ritorna numeri pronti per tutte le postazioni (raggruppati per prefix)
-    kitchens = session.exec(select(Kitchen).order_by(Kitchen.name)).all()
-    by_prefix: dict[str, list[int]] = {k.prefix: [] for k in kitchens}  # pannelli vuoti pre-creati
-
-    ready = session.exec(
-        select(Ticket)
-        .where(Ticket.status == "ready")
-        .order_by(Ticket.pickup_seq.desc())
-    ).all()
+    key = ("all", None)
+    if (cached := _cached_fragment(key)) is not None:
+        return cached
+    version = tickets_version()  # letta PRIMA della query: un bump concorrente non viene perso
 
-    k_by_id = {k.id: k for k in kitchens}
-    for t in ready:
-        k = k_by_id.get(t.kitchen_id)
-        if not k:
-            continue
-        by_prefix[k.prefix].append(int(t.pickup_seq))
+    by_prefix = _ready_by_prefix(session)
+    return _store_fragment(key, version, HTMLResponse(_TPL_DISPLAY_FRAGMENT.render(
+        {"mode": "all", "by_prefix": by_prefix, "prefix": None},
+    )))
 
+@router.get("/display/{prefix}", response_class=HTMLResponse)
+def display_one_page(prefix: str, request: Request, session: SessionDep):
+    prefix = prefix.upper()
+    kitchens = kitchens_list(session)
+    kitchen = _kitchen_by_prefix(prefix, session)
+    if not kitchen:
+        raise HTTPException(404, f"Nessuna postazione {prefix}")
     return templates.TemplateResponse(
-        "display_fragment.html",
-        {"request": request, "mode": "all", "by_prefix": by_prefix, "prefix": None},
+        "display.html",
+        {"request": request, "mode": "one", "kitchen": kitchen, "kitchens": kitchens},
     )
 
 # --- menu (lista postazioni) ------------------------------------------------
 
 @router.get("/display-menu", response_class=HTMLResponse)
 def display_menu(request: Request, session: SessionDep):
-    kitchens = session.exec(select(Kitchen).order_by(Kitchen.name)).all()
+    kitchens = kitchens_list(session)
     return templates.TemplateResponse("display_menu.html", {"request": request, "kitchens": kitchens})
 
 # --- schermi ---------------------------------------------------------------
 
 @router.get("/screen", response_class=HTMLResponse)
 def screen_all(request: Request, session: SessionDep):
-    kitchens = {k.id: k for k in session.exec(select(Kitchen)).all()}
-    ready = session.exec(
-        select(Ticket)
-        .where(Ticket.status == "ready")
-        .order_by(Ticket.pickup_seq.desc())
-    ).all()
-
+    kitchens = kitchens_map(session)
     by_prefix: dict[str, list[int]] = {}
-    for t in ready:
-        k = kitchens.get(t.kitchen_id)
-        if not k:
-            continue
-        by_prefix.setdefault(k.prefix.upper(), []).append(int(t.pickup_seq))
+    for kid, seqs in _ready_seqs_by_kitchen(session).items():
+        k = kitchens.get(kid)
+        if k is not None:
+            by_prefix.setdefault(k.prefix.upper(), []).extend(seqs)
 
     return templates.TemplateResponse(
         "display_screen.html",
@@ -144,18 +209,17 @@ def display_screen_full(request: Request, prefix: str):
 @router.get("/display/{prefix}/fragment", response_class=HTMLResponse)
 def display_one_fragment(prefix: str, request: Request, session: SessionDep):
     prefix = prefix.upper()
+    key = ("one", prefix)
+    if (cached := _cached_fragment(key)) is not None:
+        return cached
+    version = tickets_version()
+
     kitchen = _kitchen_by_prefix(prefix, session)
     if not kitchen:
         return HTMLResponse("Postazione non trovata", status_code=404)
 
-    ready = session.exec(
-        select(Ticket)
-        .where(Ticket.kitchen_id == kitchen.id, Ticket.status == "ready")
-        .order_by(Ticket.pickup_seq.desc())
-    ).all()
-    seqs = [int(t.pickup_seq) for t in ready]
+    seqs = _ready_seqs(kitchen, session)
 
-    return templates.TemplateResponse(
-        "display_fragment.html",
-        {"request": request, "mode": "one", "by_prefix": None, "prefix": prefix, "seqs": seqs},
-    )
+    return _store_fragment(key, version, HTMLResponse(_TPL_DISPLAY_FRAGMENT.render(
+        {"mode": "one", "by_prefix": None, "prefix": prefix, "seqs": seqs},
+    )))
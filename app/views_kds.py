@@ -1,70 +1,76 @@
 # app/views_kds.py
 from __future__ import annotations
 
+import secrets
+from collections import defaultdict
 from datetime import datetime, timezone
 from typing import Annotated, Dict, List
 
 from fastapi import APIRouter, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, Response
+from sqlalchemy import and_, exists, update
 from sqlmodel import select, Session
 
+from .cache import bump_tickets_version, kitchens_list, request_memo, tickets_version
 from .db import get_session_dep
 from .ws import manager
-from .models import Kitchen, Ticket, Order, OrderLine, Product
+from .models import Kitchen, Ticket, OrderLine, Product
 from .models_customizations import OrderLineOption
+from .templating import make_templates
 
 # Dipendenza tipizzata
 SessionDep = Annotated[Session, Depends(get_session_dep)]
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+templates = make_templates()
+# Fragment in polling: Template risolto una volta sola e renderizzato direttamente
+_TPL_KDS_FRAGMENT = templates.get_template("kds_fragment.html")
 
 # --- util -------------------------------------------------------------------
 
-def _age_human(dt: datetime | None) -> str:
+def _epoch(dt: datetime | None) -> int | None:
+    """created_at (UTC naive) -> epoch secondi: l'età la calcola il browser."""
     if not dt:
-        return ""
-    try:
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        sec = int((datetime.now(timezone.utc) - dt).total_seconds())
-    except Exception:
-        return ""
-    m, s = divmod(sec, 60)
-    h, m = divmod(m, 60)
-    if h:
-        return f"{h}h {m}m"
-    if m:
-        return f"{m}m {s}s"
-    return f"{s}s"
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
 
 # Micro-cache Kitchen by prefix (riduce query durante polling)
 from time import time
-_KCACHE: Dict[str, dict] = {}
+# Valori (scadenza, kitchen): sul percorso caldo un solo get + un confronto
+_KCACHE: Dict[str, tuple[float, Kitchen | None]] = {}
 _KCACHE_TTL = 5.0  # secondi
 
 def _kitchen_by_prefix(prefix: str, session: Session) -> Kitchen | None:
-    key = (prefix or "").upper().strip()
+    """`prefix` va passato già normalizzato (maiuscolo)."""
+    memo = request_memo()
+    key = ("kitchen", prefix)
+    if memo is not None and key in memo:
+        return memo[key]
     now = time()
-    hit = _KCACHE.get(key)
-    if hit and (now - hit["t"] < _KCACHE_TTL):
-        return hit["v"]  # type: ignore
-    k = session.exec(select(Kitchen).where(Kitchen.prefix == key)).first()
-    _KCACHE[key] = {"v": k, "t": now}
+    hit = _KCACHE.get(prefix)
+    if hit is not None and hit[0] > now:
+        k = hit[1]
+    else:
+        k = session.exec(select(Kitchen).where(Kitchen.prefix == prefix)).first()
+        _KCACHE[prefix] = (now + _KCACHE_TTL, k)
+    if memo is not None:
+        memo[key] = k
     return k
 
 # --- pagine -----------------------------------------------------------------
 
 @router.get("/kds", response_class=HTMLResponse)
 def kds_index(request: Request, session: SessionDep):
-    kitchens = session.exec(select(Kitchen).order_by(Kitchen.prefix.asc())).all()
+    kitchens = kitchens_list(session, "prefix")
     return templates.TemplateResponse("kds_index.html", {"request": request, "kitchens": kitchens})
 
 @router.get("/kds/{prefix}", response_class=HTMLResponse)
 def kds_page(prefix: str, request: Request, session: SessionDep):
     """Pagina host KDS (carica il fragment via fetch)."""
-    k = _kitchen_by_prefix(prefix, session)
+    k = _kitchen_by_prefix((prefix or "").strip().upper(), session)
     if not k:
         raise HTTPException(status_code=404, detail="Postazione non trovata")
     return templates.TemplateResponse(
@@ -88,54 +94,100 @@ def kds_fragment(request: Request, session: SessionDep, prefix: str):
     """Ritorna solo il corpo (cards) – usato dal polling e dai poke WS."""
     px = (prefix or "").upper()
 
-    k = session.exec(select(Kitchen).where(Kitchen.prefix == px)).first()
-    if not k:
+    # ETag = versione ticket (l'età nelle card la aggiorna il browser):
+    # se il client ha già questa versione -> 304
+    etag = _etag(px, tickets_version())
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    rendered = _kds_fragment_html(session, px)
+    if rendered is None:
         return HTMLResponse("<div class='tag'>Nessuna postazione trovata</div>", status_code=404)
 
+    resp = HTMLResponse(rendered[1])
+    resp.headers["ETag"] = rendered[0]
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+# La versione ticket riparte da 0 a ogni avvio (uvicorn --reload riavvia spesso):
+# il nonce di processo evita che un ETag di prima del riavvio dia un 304 sbagliato
+_ETAG_NONCE = secrets.token_hex(4)
+
+def _etag(px: str, version: int) -> str:
+    return f'W/"{px}-{_ETAG_NONCE}-{version}"'
+
+# HTML del fragment per postazione, valido finché non cambia la versione ticket:
+# lo condividono il polling e il push WS dopo le azioni KDS
+_FRAG_CACHE: dict[str, tuple[int, str]] = {}
+
+def _kds_fragment_html(session: Session, px: str) -> tuple[str, str] | None:
+    """(etag, html) del fragment della postazione `px`, o None se non esiste."""
+    version = tickets_version()  # letta PRIMA delle query: un bump concorrente non viene perso
+    hit = _FRAG_CACHE.get(px)
+    if hit is not None and hit[0] == version:
+        return _etag(px, version), hit[1]
+
+    k = _kitchen_by_prefix(px, session)
+    if not k:
+        return None
+
     # 👇 estrai SUBITO scalari e usa solo questi (no ORM object dopo)
     k_id = int(k.id)
     k_prefix = (k.prefix or "").upper()
     k_name = k.name or ""
 
+    active = (Ticket.kitchen_id == k_id, Ticket.status.in_(("queued", "prepping", "ready")))
+
+    # 1) Ticket attivi (created_at dell'ordine è già copiato sul ticket)
     tickets = session.exec(
-        select(Ticket)
-        .where(
-            Ticket.kitchen_id == k_id,
-            Ticket.status.in_(("queued", "prepping", "ready")),
-        )
-        .order_by(Ticket.pickup_seq)
+        select(Ticket).where(*active).order_by(Ticket.pickup_seq)
     ).all()
 
-    # Cache prodotti per nome (mappa scalare -> scalare)
-    prod_map = {int(p.id): p.name for p in session.exec(select(Product)).all()}
+    # 2) Tutte le righe dei ticket attivi in una query, raggruppate per (ordine, seq);
+    #    righe e opzioni si consumano a blocchi (yield_per) senza lista intermedia
+    lines_by_ticket: defaultdict[tuple[int, int], list[OrderLine]] = defaultdict(list)
+    line_ids: list[int] = []
+    if tickets:
+        for ln in session.exec(
+            select(OrderLine)
+            .join(Ticket, and_(
+                Ticket.kitchen_id == OrderLine.kitchen_id,
+                Ticket.pickup_seq == OrderLine.pickup_seq,
+                Ticket.order_id == OrderLine.order_id,
+            ))
+            .where(*active)
+            .order_by(OrderLine.id)
+            .execution_options(yield_per=200)
+        ):
+            lines_by_ticket[(ln.order_id, ln.pickup_seq)].append(ln)
+            line_ids.append(ln.id)
+
+    # Nomi dei soli prodotti presenti nei ticket (id, nome: niente entità ORM)
+    pids = {ln.product_id for lines in lines_by_ticket.values() for ln in lines}
+    prod_map = dict(session.exec(
+        select(Product.id, Product.name).where(Product.id.in_(pids))
+    ).all()) if pids else {}
+
+    # 3) Opzioni di tutte quelle righe in una query
+    opts_by_line: defaultdict[int, list[OrderLineOption]] = defaultdict(list)
+    if line_ids:
+        for o in session.exec(
+            select(OrderLineOption)
+            .where(OrderLineOption.orderline_id.in_(line_ids))
+            .execution_options(yield_per=200)
+        ):
+            opts_by_line[o.orderline_id].append(o)
 
     # Prepara le righe
     view = []
     for t in tickets:
-        lines = session.exec(
-            select(OrderLine).where(
-                OrderLine.kitchen_id == k_id,
-                OrderLine.pickup_seq == t.pickup_seq,
-                OrderLine.order_id == t.order_id,
-            )
-        ).all()
-
-        line_ids = [int(ln.id) for ln in lines]
-        opts_by_line: dict[int, list[OrderLineOption]] = {}
-        if line_ids:
-            all_opts = session.exec(
-                select(OrderLineOption).where(OrderLineOption.orderline_id.in_(line_ids))
-            ).all()
-            for o in all_opts:
-                opts_by_line.setdefault(int(o.orderline_id), []).append(o)
-
         items = []
-        for ln in lines:
-            pname = prod_map.get(int(ln.product_id))
+        for ln in lines_by_ticket.get((t.order_id, t.pickup_seq), ()):
+            pname = prod_map.get(ln.product_id)
             if not pname:
                 continue
             item = {"name": pname, "qty": int(ln.qty or 0)}
-            line_opts = opts_by_line.get(int(ln.id)) or []
+            line_opts = opts_by_line.get(ln.id)
             if line_opts:
                 item["options"] = [
                     {"name": (o.prompt_name or ""), "value": (o.value or "")}
@@ -143,24 +195,18 @@ def kds_fragment(request: Request, session: SessionDep, prefix: str):
                 ]
             items.append(item)
 
-        created = None
-        if t.order_id:
-            order = session.get(Order, t.order_id)
-            created = getattr(order, "created_at", None)
-
         view.append({
             "seq": t.pickup_seq,
             "status": t.status,
-            "age": _age_human(created),
+            "created_ts": _epoch(t.order_created_at),
             "items": items,
         })
 
-    resp = templates.TemplateResponse(
-        "kds_fragment.html",
-        {"request": request, "prefix": k_prefix, "kitchen_name": k_name, "tickets": view},
+    html = _TPL_KDS_FRAGMENT.render(
+        {"prefix": k_prefix, "kitchen_name": k_name, "tickets": view},
     )
-    resp.headers["Cache-Control"] = "no-store, max-age=0"
-    return resp
+    _FRAG_CACHE[px] = (version, html)
+    return _etag(px, version), html
 
 
 # --- helpers ----------------------------------------------------------------
@@ -168,86 +214,71 @@ def kds_fragment(request: Request, session: SessionDep, prefix: str):
 def _state_response(request: Request, prefix: str, payload: dict):
     # Se arrivi dal fetch JS, rispondi JSON. Altrimenti redirect gentile alla pagina KDS
     if request.headers.get("X-Fetch") == "1":
-        return JSONResponse(payload)
+        return ORJSONResponse(payload)
     return RedirectResponse(url=f"/kds/{prefix}", status_code=303)
 
 # --- azioni KDS -------------------------------------------------------------
-
-@router.post("/kds/{prefix}/{seq}/preparing")
-async def kds_preparing(request: Request, prefix: str, seq: int, session: SessionDep):
-    px = (prefix or "").upper()
+# Gli handler sono async (per i broadcast WS), ma il DB è sincrono: la parte
+# DB gira nel threadpool così una scrittura lenta non blocca l'event loop.
+# Dopo ogni azione il fragment aggiornato viaggia nell'evento WS: i KDS della
+# postazione non devono rifare la GET.
+
+def _set_ticket_status(
+    session: Session, px: str, seq: int, status: str, block_delivered: bool = True
+) -> tuple[str, str] | None:
+    """Aggiorna lo stato e ritorna (etag, html) del fragment aggiornato."""
     k = _kitchen_by_prefix(px, session)
     if not k:
         raise HTTPException(status_code=404, detail="Cucina non trovata")
 
-    tk = session.exec(
-        select(Ticket).where(Ticket.kitchen_id == k.id, Ticket.pickup_seq == seq)
-    ).first()
-    if not tk:
+    # Un solo UPDATE condizionato; la SELECT serve solo a distinguere 404/409 se fallisce
+    match = (Ticket.kitchen_id == k.id, Ticket.pickup_seq == seq)
+    cond = (*match, Ticket.status != "delivered") if block_delivered else match
+    if session.exec(update(Ticket).where(*cond).values(status=status)).rowcount == 0:
+        session.rollback()
+        if session.exec(select(exists().where(*match))).one():
+            raise HTTPException(status_code=409, detail="Ticket già consegnato")
         raise HTTPException(status_code=404, detail="Ticket non trovato")
-    if tk.status == "delivered":
-        raise HTTPException(status_code=409, detail="Ticket già consegnato")
-
-    tk.status = "prepping"
-    session.add(tk)
     session.commit()
-
+    bump_tickets_version()
+    return _kds_fragment_html(session, px)
+
+async def _broadcast_state(px: str, seq: int, status: str, fragment: tuple[str, str] | None) -> None:
+    """Un solo evento WS per azione: i client decidono in base a `status`.
+    Solo i KDS di `px` ricevono anche `html` (con il suo `etag`) da applicare
+    direttamente; POS e display ricevono l'evento senza il fragment."""
+    event = {"type": "ticket_state", "prefix": px, "seq": seq, "status": status}
+    payload = event
+    if fragment is not None:
+        payload = {**event, "etag": fragment[0], "html": fragment[1]}
     try:
-        await manager.broadcast_json({"type": "ticket_update", "prefix": px, "seq": seq, "status": "prepping"})
-        await manager.broadcast_json({"type": "display_refresh", "prefix": px})
+        await manager.broadcast_to((px,), payload, unscoped_payload=event)
     except Exception:
         pass
 
+@router.post("/kds/{prefix}/{seq}/preparing")
+async def kds_preparing(request: Request, prefix: str, seq: int, session: SessionDep):
+    px = (prefix or "").upper()
+    fragment = await run_in_threadpool(_set_ticket_status, session, px, seq, "prepping")
+
+    await _broadcast_state(px, seq, "prepping", fragment)
+
     return _state_response(request, px, {"ok": True, "status": "prepping"})
 
 @router.post("/kds/{prefix}/{seq}/ready")
 async def kds_ready(request: Request, prefix: str, seq: int, session: SessionDep):
     px = (prefix or "").upper()
-    k = _kitchen_by_prefix(px, session)
-    if not k:
-        raise HTTPException(status_code=404, detail="Cucina non trovata")
-
-    tk = session.exec(
-        select(Ticket).where(Ticket.kitchen_id == k.id, Ticket.pickup_seq == seq)
-    ).first()
-    if not tk:
-        raise HTTPException(status_code=404, detail="Ticket non trovato")
-    if tk.status == "delivered":
-        raise HTTPException(status_code=409, detail="Ticket già consegnato")
+    fragment = await run_in_threadpool(_set_ticket_status, session, px, seq, "ready")
 
-    tk.status = "ready"
-    session.add(tk)
-    session.commit()
-
-    try:
-        await manager.broadcast_json({"type": "ticket_update", "prefix": px, "seq": seq, "status": "ready"})
-        await manager.broadcast_json({"type": "ticket_ready", "prefix": px, "seq": seq})
-    except Exception:
-        pass
+    await _broadcast_state(px, seq, "ready", fragment)
 
     return _state_response(request, px, {"ok": True, "status": "ready"})
 
 @router.post("/kds/{prefix}/{seq}/delivered")
 async def kds_delivered(request: Request, prefix: str, seq: int, session: SessionDep):
     px = (prefix or "").upper()
-    k = _kitchen_by_prefix(px, session)
-    if not k:
-        raise HTTPException(status_code=404, detail="Cucina non trovata")
-
-    tk = session.exec(
-        select(Ticket).where(Ticket.kitchen_id == k.id, Ticket.pickup_seq == seq)
-    ).first()
-    if not tk:
-        raise HTTPException(status_code=404, detail="Ticket non trovato")
-
-    tk.status = "delivered"
-    session.add(tk)
-    session.commit()
+    fragment = await run_in_threadpool(_set_ticket_status, session, px, seq, "delivered", block_delivered=False)
 
-    try:
-        await manager.broadcast_json({"type": "ticket_update", "prefix": px, "seq": seq, "status": "delivered"})
-        await manager.broadcast_json({"type": "ticket_delivered", "prefix": px, "seq": seq})
-    except Exception:
-        pass
+    await _broadcast_state(px, seq, "delivered", fragment)
 
     return _state_response(request, px, {"ok": True, "status": "delivered"})
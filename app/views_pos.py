@@ -1,34 +1,42 @@
 # app/views_pos.py
 from __future__ import annotations
 
-from datetime import datetime
+import asyncio
+import hashlib
+import re
+from collections import defaultdict
 from typing import Any, Dict, Optional, List, Annotated
 from urllib.parse import quote
 
+import orjson
+
 from fastapi import APIRouter, Request, Form, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy import func as sa_func, desc
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, Response
+from sqlalchemy import func as sa_func, desc, insert, update
 from sqlmodel import select, Session
 
-from .db import get_session_dep
+from .cache import ProductRow, bump_tickets_version, kitchens_map, pos_catalog, product_prompts, products_map
+from .db import engine, format_dt, get_session_dep
 from .ws import manager
 from .printing import print_kitchen_receipt, print_category_receipt
-from .models import Product, Order, OrderLine, Kitchen, Ticket, Category
-from .models_customizations import ProductPrompt, OrderLineOption
+from .models import Product, Order, OrderLine, Kitchen, Ticket
+from .models_customizations import OrderLineOption
+from .templating import make_templates
 from .receipts.models_receipts import PrintedReceipt, Printer
 from .receipts.printing_service import print_text
 from app.receipts.rules_engine import apply_receipt_rules
 
-router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+router = APIRouter(default_response_class=ORJSONResponse)
+templates = make_templates()
 
 # Dipendenza tipizzata
 SessionDep = Annotated[Session, Depends(get_session_dep)]
 
 
-def _get_last_order(session: Session) -> Optional[Order]:
-    return session.exec(select(Order).order_by(desc(Order.id))).first()
+def _get_last_order_id(session: Session) -> Optional[int]:
+    # MAX sulla PK: lettura in coda all'indice, nessun Order da idratare
+    return session.exec(select(sa_func.max(Order.id))).one()
 
 
 def _fetch_order_from_your_store(session: Session, order_id: str) -> Optional[Dict[str, Any]]:
@@ -38,57 +46,65 @@ def _fetch_order_from_your_store(session: Session, order_id: str) -> Optional[Di
     except Exception:
         return None
 
-    order = session.get(Order, oid)
-    if not order:
-        return None
-
+    # Un solo round-trip: ordine + righe + prodotto + opzioni in LEFT JOIN
+    # (niente relationship nei modelli), solo colonne via .mappings()
     rows = session.exec(
-        select(OrderLine, Product)
-        .where(OrderLine.order_id == order.id)
-        .join(Product, Product.id == OrderLine.product_id)
-    ).all()
+        select(
+            Order.total_cents,
+            OrderLine.id.label("line_id"), OrderLine.qty,
+            Product.id.label("product_id"), Product.name, Product.price_cents,
+            OrderLineOption.id.label("opt_id"), OrderLineOption.prompt_name,
+            OrderLineOption.value, OrderLineOption.price_delta_cents,
+        )
+        .select_from(Order)
+        .outerjoin(OrderLine, OrderLine.order_id == Order.id)
+        .outerjoin(Product, Product.id == OrderLine.product_id)
+        .outerjoin(OrderLineOption, OrderLineOption.orderline_id == OrderLine.id)
+        .where(Order.id == oid)
+        .order_by(OrderLine.id, OrderLineOption.id)
+    ).mappings().all()
     if not rows:
-        return {"id": order.id, "items": [], "total_cents": int(order.total_cents or 0)}
+        return None
 
-    ol_ids = [ol.id for ol, _ in rows]
-    opts_rows = session.exec(
-        select(OrderLineOption).where(OrderLineOption.orderline_id.in_(ol_ids))
-    ).all()
-    opts_by_ol: Dict[int, List[OrderLineOption]] = {}
-    for r in opts_rows:
-        opts_by_ol.setdefault(r.orderline_id, []).append(r)
+    # una riga SQL per opzione: si ricompongono le righe d'ordine (dict = ordine di inserimento)
+    lines: Dict[int, Dict[str, Any]] = {}
+    for r in rows:
+        if r["product_id"] is None:  # ordine senza righe / prodotto eliminato
+            continue
+        ln = lines.get(r["line_id"])
+        if ln is None:
+            ln = lines[r["line_id"]] = {
+                "product_id": int(r["product_id"]),
+                "name": r["name"] or f"Prod {r['product_id']}",
+                "qty": int(r["qty"] or 0),
+                "base": int(r["price_cents"] or 0),
+                "options": [],
+            }
+        if r["opt_id"] is not None:
+            ln["options"].append({
+                "name": r["prompt_name"] or "",
+                "value": r["value"] or "",
+                "delta": int(r["price_delta_cents"] or 0),
+            })
 
     items: List[Dict[str, Any]] = []
     running_total = 0
 
-    for ol, prod in rows:
-        base = int(getattr(prod, "price_cents", 0) or 0)
-        ol_opts = opts_by_ol.get(ol.id, [])
-        delta = sum(int(getattr(o, "price_delta_cents", 0) or 0) for o in ol_opts)
-        unit_price_cents = max(0, base + delta)
-        qty = int(getattr(ol, "qty", 0) or 0)
-        running_total += unit_price_cents * qty
-
-        items.append({
-            "product_id": int(prod.id),
-            "name": getattr(prod, "name", f"Prod {prod.id}"),
-            "qty": qty,
-            "unit_price_cents": unit_price_cents,
-            "options": [
-                {
-                    "name": getattr(o, "prompt_name", "") or "",
-                    "value": getattr(o, "value", "") or "",
-                    "delta": int(getattr(o, "price_delta_cents", 0) or 0),
-                }
-                for o in ol_opts
-            ],
-        })
+    for ln in lines.values():
+        unit_price_cents = max(0, ln.pop("base") + sum(o["delta"] for o in ln["options"]))
+        running_total += unit_price_cents * ln["qty"]
+        ln["unit_price_cents"] = unit_price_cents
+        items.append(ln)
 
-    total_cents = int(order.total_cents or 0)
+    total_cents = int(rows[0]["total_cents"] or 0)
     if total_cents <= 0:
         total_cents = running_total
 
-    return {"id": order.id, "items": items, "total_cents": total_cents}
+    return {"id": oid, "items": items, "total_cents": total_cents}
+
+
+# "€ 1,50" -> "1.50" con una sola translate (niente replace a catena)
+_CENTS_TRANS = str.maketrans({"€": None, "\xa0": None, " ": None, ",": "."})
 
 
 def _to_cents(val: Any) -> Optional[int]:
@@ -96,15 +112,23 @@ def _to_cents(val: Any) -> Optional[int]:
         return None
     try:
         if isinstance(val, str):
-            v = val.strip().replace("€", "").replace(",", ".")
-            return int(round(float(v) * 100))
+            return int(round(float(val.translate(_CENTS_TRANS)) * 100))
         return int(round(float(val) * 100))
     except Exception:
         return None
 
 
 def _extract_unit_price_cents(item: Dict[str, Any]) -> int:
-    for k in ("unit_price_cents", "price_cents", "cents"):
+    # Caso comune: il carrello manda già unit_price_cents intero
+    v = item.get("unit_price_cents")
+    if type(v) is int and v >= 0:
+        return v
+    return _extract_unit_price_cents_slow(item)
+
+
+def _extract_unit_price_cents_slow(item: Dict[str, Any]) -> int:
+    """Payload legacy: altri nomi di chiave, prezzi in euro come stringa o solo totale riga."""
+    for k in ("price_cents", "cents"):
         v = item.get(k)
         if isinstance(v, int) and v >= 0:
             return v
@@ -128,11 +152,11 @@ def _extract_unit_price_cents(item: Dict[str, Any]) -> int:
 @router.get("/pos/util/order_summary")
 def pos_order_summary(session: SessionDep, order_id: str = ""):
     if not order_id:
-        return {"ok": False, "error": "order_id mancante"}
+        return ORJSONResponse({"ok": False, "error": "order_id mancante"})
 
     data = _fetch_order_from_your_store(session, order_id)
     if not data:
-        return {"ok": True, "order": {"id": str(order_id), "items": [], "total_cents": 0}}
+        return ORJSONResponse({"ok": True, "order": {"id": str(order_id), "items": [], "total_cents": 0}})
 
     raw_items: List[Dict[str, Any]] = data.get("items") or []
 
@@ -154,193 +178,273 @@ def pos_order_summary(session: SessionDep, order_id: str = ""):
     if not isinstance(total_cents, int):
         total_cents = running_total
 
-    return {
+    return ORJSONResponse({
         "ok": True,
         "order": {
             "id": str(data.get("id") or order_id),
             "items": items,
             "total_cents": int(total_cents or 0),
         }
-    }
+    })
 
 
 @router.get("/pos", response_class=HTMLResponse)
 def pos_page(request: Request, session: SessionDep):
-    products = session.exec(
-        select(Product).order_by(sa_func.lower(Product.name))
-    ).all()
-    kitchens_list = session.exec(select(Kitchen)).all()
-    kitchens_map = {k.id: k for k in kitchens_list}
-    categories = {c.id: c for c in session.exec(select(Category)).all()}
+    # catalogo e postazioni dalla cache di processo (invalidata dall'admin)
+    products, categories = pos_catalog(session)
+    kitchens = kitchens_map(session)
     return templates.TemplateResponse(
         "pos.html",
         {
             "request": request,
             "products": products,
-            "kitchens": kitchens_map,
-            "kitchens_map": kitchens_map,
+            "kitchens": kitchens,
+            "kitchens_map": kitchens,
             "categories": categories,
         },
     )
 
 
-@router.post("/pos/util/reprint_order")
-def pos_reprint_order(session: SessionDep, order_id: int = Form(...)):
+# --- ristampa ----------------------------------------------------------------
+# La stampa è I/O di rete bloccante: le stampanti diverse lavorano in parallelo
+# (un thread ciascuna), gli scontrini della stessa stampante restano in fila
+# per non aprire due connessioni sulla stessa porta.
+
+PrintJobs = Dict[tuple[str, int], List[tuple[str, bool]]]
+
+
+def _reprint_jobs(session: Session, order_id: int) -> tuple[PrintJobs, int] | None:
+    """({(host, port): [(body, cut)]}, scontrini non stampabili) o None se non ce ne sono."""
+    # la stampante è copiata sullo scontrino: una sola query, nessun JOIN
     rows = session.exec(
-        select(PrintedReceipt).where(PrintedReceipt.order_id == order_id).order_by(PrintedReceipt.id)
+        select(
+            PrintedReceipt.body, PrintedReceipt.cut,
+            PrintedReceipt.printer_host, PrintedReceipt.printer_port, PrintedReceipt.printer_enabled,
+        ).where(PrintedReceipt.order_id == order_id).order_by(PrintedReceipt.id)
     ).all()
     if not rows:
-        return JSONResponse({"ok": False, "error": "Nessuno scontrino per questo ordine"})
+        return None
 
-    ok = 0
-    fail = 0
-    for r in rows:
-        prn = session.get(Printer, r.printer_id)
-        if not prn or not prn.enabled:
-            fail += 1
+    jobs: PrintJobs = defaultdict(list)
+    skipped = 0
+    for body, cut, host, port, enabled in rows:
+        if not enabled or not host:
+            skipped += 1
             continue
+        jobs[(host, port)].append((body, cut))
+    return jobs, skipped
+
+
+def _print_batch(host: str, port: int, batch: List[tuple[str, bool]]) -> tuple[int, int]:
+    ok = fail = 0
+    for body, cut in batch:
         try:
-            print_text(prn.host, prn.port, r.body, do_cut=r.cut)
+            print_text(host, port, body, do_cut=cut)
             ok += 1
         except Exception:
             fail += 1
+    return ok, fail
+
+
+async def _run_print_jobs(jobs: PrintJobs) -> tuple[int, int]:
+    """(ok, fail) totali; il tempo è quello della stampante più lenta, non la somma."""
+    results = await asyncio.gather(*(
+        run_in_threadpool(_print_batch, host, port, batch)
+        for (host, port), batch in jobs.items()
+    ))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+@router.post("/pos/util/reprint_order")
+async def pos_reprint_order(session: SessionDep, order_id: int = Form(...)):
+    loaded = await run_in_threadpool(_reprint_jobs, session, order_id)
+    if loaded is None:
+        return ORJSONResponse({"ok": False, "error": "Nessuno scontrino per questo ordine"})
+
+    jobs, fail = loaded
+    ok, failed = await _run_print_jobs(jobs)
+
+    return ORJSONResponse({"ok": True, "reprinted": ok, "failed": fail + failed, "order_id": order_id})
+
 
-    return JSONResponse({"ok": True, "reprinted": ok, "failed": fail, "order_id": order_id})
+def _json_revalidated(request: Request, payload: dict) -> Response:
+    """JSON con ETag sul contenuto: se il client ha già questi byte -> 304 vuota.
+    Niente max-age: il POS rilegge subito dopo checkout/ristampa e deve vedere i dati nuovi."""
+    body = orjson.dumps(payload)
+    etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 @router.get("/pos/util/orders")
-def pos_orders(session: SessionDep, limit: int = 20):
+def pos_orders(request: Request, session: SessionDep, limit: int = 20):
     orders = session.exec(
-        select(Order).order_by(desc(Order.id)).limit(max(1, min(limit, 10)))
-    ).all()
+        select(Order.id, format_dt(Order.created_at).label("created_at")).order_by(desc(Order.id)).limit(max(1, min(limit, 10)))
+    ).mappings().all()
     if not orders:
-        return JSONResponse({"ok": True, "orders": []})
-
-    ids = [o.id for o in orders]
-
-    logs = session.exec(
-        select(PrintedReceipt).where(PrintedReceipt.order_id.in_(ids)).order_by(PrintedReceipt.id)
-    ).all()
-    logs_by_order: Dict[int, List[PrintedReceipt]] = {}
-    for r in logs:
-        logs_by_order.setdefault(r.order_id, []).append(r)
+        return _json_revalidated(request, {"ok": True, "orders": []})
+
+    # Sono gli ultimi N id: "order_id >= il più piccolo" seleziona gli stessi ordini
+    # di IN(ids), ma con un testo SQL che non cambia con N (cache degli statement)
+    min_id = orders[-1]["id"]
+
+    # scontrini contati in SQL: una riga per ordine con (totale, ok)
+    receipts_by_order: dict[int, tuple[int, int]] = {
+        order_id: (total, ok)
+        for order_id, total, ok in session.exec(
+            select(
+                PrintedReceipt.order_id,
+                sa_func.count(),
+                sa_func.count().filter(PrintedReceipt.status == "ok"),
+            )
+            .where(PrintedReceipt.order_id >= min_id)
+            .group_by(PrintedReceipt.order_id)
+        ).all()
+    }
 
+    # quantità per (ordine, prodotto) sommate in SQL; ordinate per prima riga inserita
     rows = session.exec(
-        select(OrderLine, Product)
-        .where(OrderLine.order_id.in_(ids))
+        select(OrderLine.order_id, Product.name, sa_func.sum(OrderLine.qty))
         .join(Product, Product.id == OrderLine.product_id)
+        .where(OrderLine.order_id >= min_id)
+        .group_by(OrderLine.order_id, Product.name)
+        .order_by(sa_func.min(OrderLine.id))
     ).all()
-    items_by_order: dict[int, dict[str, int]] = {}
-    for ol, prod in rows:
-        m = items_by_order.setdefault(ol.order_id, {})
-        name = getattr(prod, "name", f"Prod {prod.id}")
-        qty = getattr(ol, "qty", 0) or 0
-        m[name] = m.get(name, 0) + qty
+    items_by_order: defaultdict[int, list[dict]] = defaultdict(list)
+    for order_id, name, qty in rows:
+        items_by_order[order_id].append({"name": name, "qty": int(qty or 0)})
 
     data = []
     for o in orders:
-        lst = logs_by_order.get(o.id, [])
-        ok = sum(1 for x in lst if x.status == "ok")
-        err = sum(1 for x in lst if x.status != "ok")
-        items_map = items_by_order.get(o.id, {})
-        items = [{"name": n, "qty": q} for n, q in items_map.items()]
+        total_receipts, ok = receipts_by_order.get(o["id"], (0, 0))
+        items = items_by_order.get(o["id"], [])
         data.append({
-            "order_id": o.id,
-            "created_at": getattr(o, "created_at", None).strftime("%d/%m/%Y %H:%M:%S") if getattr(o, "created_at", None) else "",
-            "receipts_total": len(lst),
+            "order_id": o["id"],
+            "created_at": o["created_at"] or "",
+            "receipts_total": total_receipts,
             "receipts_ok": ok,
-            "receipts_err": err,
+            "receipts_err": total_receipts - ok,
             "items": items,
         })
 
-    return JSONResponse({"ok": True, "orders": data})
+    return _json_revalidated(request, {"ok": True, "orders": data})
 
 
 @router.get("/pos/util/last_receipts")
-def pos_last_receipts(session: SessionDep):
-    order = _get_last_order(session)
-    if not order:
-        return JSONResponse({"ok": True, "order_id": None, "receipts": []})
+def pos_last_receipts(request: Request, session: SessionDep):
+    order_id = _get_last_order_id(session)
+    if order_id is None:
+        return _json_revalidated(request, {"ok": True, "order_id": None, "receipts": []})
 
+    # nome stampante in JOIN (LEFT: la stampante può essere stata eliminata)
     rows = session.exec(
-        select(PrintedReceipt).where(PrintedReceipt.order_id == order.id).order_by(PrintedReceipt.id)
-    ).all()
-
-    pmap = {p.id: p.name for p in session.exec(select(Printer)).all()}
+        select(
+            PrintedReceipt.id, format_dt(PrintedReceipt.created_at).label("created_at"), PrintedReceipt.printer_id,
+            PrintedReceipt.status, PrintedReceipt.summary, Printer.name.label("printer_name"),
+        )
+        .outerjoin(Printer, Printer.id == PrintedReceipt.printer_id)
+        .where(PrintedReceipt.order_id == order_id).order_by(PrintedReceipt.id)
+    ).mappings().all()
 
     data = []
     for r in rows:
         data.append({
-            "log_id": r.id,
-            "created_at": r.created_at.strftime("%d/%m/%Y %H:%M:%S"),
-            "printer_id": r.printer_id,
-            "printer_name": pmap.get(r.printer_id, f"#{r.printer_id}"),
-            "status": r.status,
-            "summary": r.summary or "",
+            "log_id": r["id"],
+            "created_at": r["created_at"] or "",
+            "printer_id": r["printer_id"],
+            "printer_name": r["printer_name"] if r["printer_name"] is not None else f"#{r['printer_id']}",
+            "status": r["status"],
+            "summary": r["summary"] or "",
         })
-    return JSONResponse({"ok": True, "order_id": order.id, "receipts": data})
+    return _json_revalidated(request, {"ok": True, "order_id": order_id, "receipts": data})
 
 
 @router.post("/pos/util/reprint_one")
 def pos_reprint_one(session: SessionDep, log_id: int = Form(...)):
     rec = session.get(PrintedReceipt, log_id)
     if not rec:
-        return JSONResponse({"ok": False, "error": "Log non trovato"})
+        return ORJSONResponse({"ok": False, "error": "Log non trovato"})
 
-    prn = session.get(Printer, rec.printer_id)
-    if not prn or not prn.enabled:
-        return JSONResponse({"ok": False, "error": "Stampante non disponibile"})
+    if not rec.printer_enabled or not rec.printer_host:
+        return ORJSONResponse({"ok": False, "error": "Stampante non disponibile"})
 
     try:
-        print_text(prn.host, prn.port, rec.body, do_cut=rec.cut)
-        return JSONResponse({"ok": True})
+        print_text(rec.printer_host, rec.printer_port, rec.body, do_cut=rec.cut)
+        return ORJSONResponse({"ok": True})
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)[:300]})
+        return ORJSONResponse({"ok": False, "error": str(e)[:300]})
 
 
 @router.post("/pos/util/reprint_last_all")
-def pos_reprint_last_all(session: SessionDep):
-    order = _get_last_order(session)
-    if not order:
-        return JSONResponse({"ok": False, "error": "Nessun ordine trovato"})
+async def pos_reprint_last_all(session: SessionDep):
+    order_id = await run_in_threadpool(_get_last_order_id, session)
+    if order_id is None:
+        return ORJSONResponse({"ok": False, "error": "Nessun ordine trovato"})
 
-    rows = session.exec(
-        select(PrintedReceipt).where(PrintedReceipt.order_id == order.id).order_by(PrintedReceipt.id)
-    ).all()
-    if not rows:
-        return JSONResponse({"ok": False, "error": "Nessun scontrino per l'ultimo ordine"})
+    loaded = await run_in_threadpool(_reprint_jobs, session, order_id)
+    if loaded is None:
+        return ORJSONResponse({"ok": False, "error": "Nessun scontrino per l'ultimo ordine"})
 
-    ok = 0
-    fail = 0
-    for r in rows:
-        prn = session.get(Printer, r.printer_id)
-        if not prn or not prn.enabled:
-            fail += 1
-            continue
-        try:
-            print_text(prn.host, prn.port, r.body, do_cut=r.cut)
-            ok += 1
-        except Exception:
-            fail += 1
+    jobs, fail = loaded
+    ok, failed = await _run_print_jobs(jobs)
 
-    return JSONResponse({"ok": True, "reprinted": ok, "failed": fail, "order_id": order.id})
+    return ORJSONResponse({"ok": True, "reprinted": ok, "failed": fail + failed, "order_id": order_id})
 
 
 @router.get("/api/products/{product_id}/prompts")
 def api_product_prompts(session: SessionDep, product_id: int):
-    rows = session.exec(
-        select(ProductPrompt).where(ProductPrompt.product_id == product_id)
-    ).all()
-    out = []
-    for r in rows:
-        out.append({
-            "name": r.name,
-            "kind": r.kind,
-            "required": bool(r.required),
-            "choices": r.choices or [],
-            "delta": int(r.delta_cents or 0),
-        })
-    return JSONResponse(out)
+    # dalla cache di processo (invalidata dal salvataggio prompt in admin)
+    return ORJSONResponse(product_prompts(session, product_id))
+
+
+# Task in background: riferimento forte finché girano (asyncio tiene solo weakref)
+_BG_TASKS: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+
+async def _after_checkout(
+    kitchen_print_jobs: list[tuple[str, int, list[tuple[str, int]]]],
+    category_print_jobs: list[tuple[str, list[tuple[str, int]]]],
+    prefixes: list[str],
+) -> None:
+    """Stampe (in parallelo, nel threadpool) e poi notifica WS ai KDS."""
+    results = await asyncio.gather(
+        *(run_in_threadpool(print_kitchen_receipt, prefix, seq, lines)
+          for prefix, seq, lines in kitchen_print_jobs),
+        *(run_in_threadpool(print_category_receipt, cat_name, lines)
+          for cat_name, lines in category_print_jobs),
+        return_exceptions=True,
+    )
+    for r in results:
+        if isinstance(r, Exception):
+            print(f"[PRINT][WARN] stampa fallita: {r}")
+
+    if prefixes:
+        try:
+            # solo ai KDS delle postazioni coinvolte: POS e display non usano l'evento
+            await manager.broadcast_to(prefixes, {"type": "tickets_created", "kitchens": prefixes})
+        except Exception as e:
+            print(f"[POS][WARN] broadcast fallito: {e}")
+
+
+def _apply_receipt_rules_bg(order_id: int) -> None:
+    """Regole scontrini (render + stampa + log) su una sessione propria, a ordine già committato."""
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            apply_receipt_rules(session, order_id)
+    except Exception as e:
+        print(f"[RULES][WARN] ordine {order_id}: {e}")
+
+
+# Form legacy: un campo qty_<product_id> per prodotto
+_QTY_RE = re.compile(r"qty_(\d+)\Z")
 
 
 @router.post("/pos/checkout")
@@ -352,8 +456,7 @@ async def pos_checkout(request: Request, session: SessionDep, paid_method: str =
     cart_json = form.get("cart_json")
     if cart_json:
         try:
-            import json
-            parsed = json.loads(cart_json)
+            parsed = orjson.loads(cart_json)
             if isinstance(parsed, list):
                 cart_lines = parsed  # [{product_id, name, qty, unit_price_cents, options:[{name,value,delta}]}]
         except Exception as e:
@@ -373,14 +476,15 @@ async def pos_checkout(request: Request, session: SessionDep, paid_method: str =
         items = list(agg.items())
     else:
         for key, val in form.items():
-            if key.startswith("qty_"):
-                try:
-                    pid = int(key.split("_", 1)[1])
-                    qty = int(val or "0")
-                except ValueError:
-                    continue
-                if qty > 0:
-                    items.append((pid, qty))
+            m = _QTY_RE.match(key)
+            if m is None:
+                continue
+            try:
+                qty = int(val or "0")
+            except ValueError:
+                continue
+            if qty > 0:
+                items.append((int(m.group(1)), qty))
 
     if not items:
         return RedirectResponse(url="/pos", status_code=303)
@@ -390,21 +494,17 @@ async def pos_checkout(request: Request, session: SessionDep, paid_method: str =
     category_print_jobs: list[tuple[str, list[tuple[str, int]]]] = []      # (category_name, [(name, qty)])
     nums_for_ui: list[str] = []
 
-    # cache di riferimento
-    pid_list = [pid for pid, _ in items]
-    prods = {p.id: p for p in session.exec(select(Product).where(Product.id.in_(pid_list))).all()}
-    kitchens = {k.id: k for k in session.exec(select(Kitchen)).all()}
-    categories = {c.id: c for c in session.exec(select(Category)).all()}
+    # prodotti e categorie dalla cache del catalogo (invalidata dall'admin):
+    # a regime il checkout non li rilegge dal DB
+    catalog = products_map(session)
+    _, categories = pos_catalog(session)
+    prods = {pid: catalog[pid] for pid, _ in items if pid in catalog}
 
-    order = Order(
-        paid_method=paid_method,
-        created_at=datetime.utcnow(),
-        total_cents=0
-    )
+    order = Order(paid_method=paid_method, total_cents=0)  # created_at: default del modello
     session.add(order)
     session.flush()  # ottieni order.id
 
-    def resolve_kitchen_id(p: Product) -> int | None:
+    def resolve_kitchen_id(p: ProductRow) -> int | None:
         if p.kitchen_id:
             return p.kitchen_id
         if p.category_id:
@@ -422,20 +522,43 @@ async def pos_checkout(request: Request, session: SessionDep, paid_method: str =
         if k_id is not None:
             kitchens_involved.add(k_id)
 
+    # Numeri di ritiro: un solo UPDATE atomico (next_seq = next_seq + 1 ... RETURNING)
+    # per tutte le cucine coinvolte, senza leggere e riscrivere le righe Kitchen
     assigned_seq: dict[int, int] = {}
-    for k_id in kitchens_involved:
-        k = kitchens[k_id]
-        assigned_seq[k_id] = k.next_seq
-        if k.prefix not in prefixes:
-            prefixes.append(k.prefix)
-
-    nums_for_ui = [f"{kitchens[k_id].prefix.upper()}-{seq}" for k_id, seq in assigned_seq.items()]
+    if kitchens_involved:
+        bumped = session.exec(
+            update(Kitchen)
+            .where(Kitchen.id.in_(kitchens_involved))
+            .values(next_seq=Kitchen.next_seq + 1)
+            .returning(Kitchen.id, Kitchen.prefix, Kitchen.next_seq)
+        ).all()
+        for k_id, k_prefix, next_seq in sorted(bumped):
+            assigned_seq[k_id] = next_seq - 1
+            if k_prefix not in prefixes:
+                prefixes.append(k_prefix)
+            nums_for_ui.append(f"{k_prefix.upper()}-{next_seq - 1}")
 
     for k_id, seq in assigned_seq.items():
-        session.add(Ticket(kitchen_id=k_id, order_id=order.id, pickup_seq=seq))
+        session.add(Ticket(kitchen_id=k_id, order_id=order.id, pickup_seq=seq, order_created_at=order.created_at))
 
     total = 0
 
+    # Righe e opzioni come dict: due INSERT multi-riga (righe con RETURNING id,
+    # nell'ordine dei parametri, poi opzioni) al posto delle entità ORM
+    line_rows: list[dict] = []
+    line_options: list[list[dict]] = []
+
+    def add_line(p: ProductRow, qty: int, options: list[dict]) -> None:
+        k_id = resolve_kitchen_id(p)
+        line_rows.append({
+            "order_id": order.id,
+            "product_id": p.id,
+            "qty": qty,
+            "kitchen_id": k_id,
+            "pickup_seq": assigned_seq.get(k_id) if k_id is not None else None,
+        })
+        line_options.append(options)
+
     if cart_lines:
         for cl in cart_lines:
             try:
@@ -457,75 +580,43 @@ async def pos_checkout(request: Request, session: SessionDep, paid_method: str =
                 unit_price = int(p.price_cents or 0) + sum(int(o.get("delta") or 0) for o in options)
 
             total += unit_price * qty
-
-            k_id = resolve_kitchen_id(p)
-            seq = assigned_seq.get(k_id) if k_id is not None else None
-            ol = OrderLine(
-                order_id=order.id,
-                product_id=p.id,
-                qty=qty,
-                kitchen_id=k_id,
-                pickup_seq=seq
-            )
-            session.add(ol)
-            session.flush()
-
-            for opt in options:
-                session.add(OrderLineOption(
-                    orderline_id=ol.id,
-                    prompt_name=str(opt.get("name") or ""),
-                    value=str(opt.get("value") or ""),
-                    price_delta_cents=int(opt.get("delta") or 0),
-                ))
+            add_line(p, qty, options)
     else:
         for pid, qty in items:
             p = prods.get(pid)
             if not p:
                 continue
             total += p.price_cents * qty
-            k_id = resolve_kitchen_id(p)
-            seq = assigned_seq.get(k_id) if k_id is not None else None
-            session.add(OrderLine(
-                order_id=order.id,
-                product_id=p.id,
-                qty=qty,
-                kitchen_id=k_id,
-                pickup_seq=seq
-            ))
-
-    order.total_cents = total
-    session.add(order)
-
-    for k_id in kitchens_involved:
-        kitchens[k_id].next_seq += 1
-        session.add(kitchens[k_id])
-
-    apply_receipt_rules(session, order.id)
+            add_line(p, qty, [])
+
+    if line_rows:
+        line_ids = session.exec(
+            insert(OrderLine).returning(OrderLine.id, sort_by_parameter_order=True),
+            params=line_rows,
+        ).scalars().all()
+        opt_rows = [
+            {
+                "orderline_id": ol_id,
+                "prompt_name": str(opt.get("name") or ""),
+                "value": str(opt.get("value") or ""),
+                "price_delta_cents": int(opt.get("delta") or 0),
+            }
+            for ol_id, options in zip(line_ids, line_options)
+            for opt in options
+        ]
+        if opt_rows:
+            session.exec(insert(OrderLineOption), params=opt_rows)
+
+    order.total_cents = total  # già nella sessione: basta la modifica, il commit la scrive
 
     session.commit()
+    bump_tickets_version()
 
-    # Notifica dettagliata per ogni KDS
-    created_by_prefix = {}
-    tks = session.exec(select(Ticket).where(Ticket.order_id == order.id)).all()
-    kitchens_now = {k.id: k for k in session.exec(select(Kitchen)).all()}
-    for tk in tks:
-        k = kitchens_now.get(tk.kitchen_id)
-        if not k:
-            continue
-        px = k.prefix.upper()
-        created_by_prefix.setdefault(px, []).append(tk.id)
-
-    # ----------- STAMPA (fuori dalla sessione) -----------
-    try:
-        for prefix, seq, lines in kitchen_print_jobs:
-            print_kitchen_receipt(prefix, seq, lines)
-        for cat_name, lines in category_print_jobs:
-            print_category_receipt(cat_name, lines)
-    except Exception as e:
-        print(f"[PRINT][WARN] stampa fallita: {e}")
-
-    if prefixes:
-        await manager.broadcast_json({"type": "tickets_created", "kitchens": prefixes})
+    # ----------- STAMPA + NOTIFICA (in background: il redirect parte subito) -----------
+    # le regole scontrini stampano in rete: girano nel threadpool, fuori dalla
+    # richiesta, e non ritardano la notifica ai KDS
+    _spawn(run_in_threadpool(_apply_receipt_rules_bg, order.id))
+    _spawn(_after_checkout(kitchen_print_jobs, category_print_jobs, prefixes))
 
     nums_param = quote(",".join(nums_for_ui)) if nums_for_ui else ""
     return RedirectResponse(
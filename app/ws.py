@@ -1,36 +1,76 @@
 # app/ws.py
-import json
-from typing import Set
+import asyncio
+import orjson
+from typing import Dict, Iterable, Optional, Set
 from fastapi import WebSocket
 
 class ConnectionManager:
     def __init__(self) -> None:
         self.active_connections: Set[WebSocket] = set()
+        # Client iscritti a una sola postazione (KDS: /ws?prefix=C) e client
+        # senza iscrizione (POS, display, host): a questi ultimi broadcast_to
+        # manda solo il payload "unscoped" scelto dal chiamante
+        self.by_prefix: Dict[str, Set[WebSocket]] = {}
+        self.unscoped: Set[WebSocket] = set()
+        self._prefix_of: Dict[WebSocket, str] = {}
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, prefix: Optional[str] = None):
         await websocket.accept()
         self.active_connections.add(websocket)
+        if prefix:
+            prefix = prefix.upper()
+            self.by_prefix.setdefault(prefix, set()).add(websocket)
+            self._prefix_of[websocket] = prefix
+        else:
+            self.unscoped.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        try:
-            self.active_connections.discard(websocket)
-        except Exception:
-            pass
+        self.active_connections.discard(websocket)
+        self.unscoped.discard(websocket)
+        prefix = self._prefix_of.pop(websocket, None)
+        if prefix is not None:
+            subs = self.by_prefix.get(prefix)
+            if subs is not None:
+                subs.discard(websocket)
+                if not subs:
+                    del self.by_prefix[prefix]
+
+    async def _send_all(self, conns: Iterable[WebSocket], message: str):
+        """Invia a `conns` in parallelo (un client lento non ritarda gli altri);
+        rimuove quelli morti."""
+        conns = list(conns)
+        results = await asyncio.gather(
+            *(ws.send_text(message) for ws in conns), return_exceptions=True
+        )
+        for ws, r in zip(conns, results):
+            if isinstance(r, Exception):
+                self.disconnect(ws)
 
     async def broadcast_text(self, message: str):
-        """Invia testo a tutti i client connessi; rimuove quelli morti."""
-        dead = []
-        for ws in list(self.active_connections):
-            try:
-                await ws.send_text(message)
-            except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(ws)
+        """Invia testo a tutti i client connessi."""
+        await self._send_all(self.active_connections, message)
 
     async def broadcast_json(self, payload: dict):
-        """Invia JSON a tutti i client connessi."""
-        await self.broadcast_text(json.dumps(payload))
+        """Invia JSON a tutti i client connessi (serializzato una volta sola, con orjson)."""
+        await self.broadcast_text(orjson.dumps(payload).decode())
+
+    async def broadcast_to(
+        self, prefixes: Iterable[str], payload: dict, unscoped_payload: Optional[dict] = None
+    ):
+        """`payload` solo ai client iscritti alle postazioni `prefixes`.
+
+        I client senza iscrizione (POS, display, host) ricevono `unscoped_payload`,
+        di solito una versione ridotta senza i dati della sola cucina; None = niente.
+        """
+        scoped: Set[WebSocket] = set()
+        for p in prefixes:
+            scoped |= self.by_prefix.get(p.upper(), set())
+        sends = []
+        if scoped:
+            sends.append(self._send_all(scoped, orjson.dumps(payload).decode()))
+        if unscoped_payload is not None and self.unscoped:
+            sends.append(self._send_all(self.unscoped, orjson.dumps(unscoped_payload).decode()))
+        await asyncio.gather(*sends)
 
 
 manager = ConnectionManager()
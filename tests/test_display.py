@@ -0,0 +1,18 @@
+# tests/test_display.py
+import os
+import tempfile
+
+# DB temporaneo: va impostato prima di importare l'app (app.db legge l'URL all'import)
+os.environ["CALCIONE_DB_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+
+def test_display_fragment_all_kitchens():
+    # /display/fragment non deve finire nella route /display/{prefix}
+    with TestClient(app) as client:
+        resp = client.get("/display/fragment")
+        assert resp.status_code == 200
+        assert "Nessuna postazione" not in resp.text